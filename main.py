@@ -4,17 +4,35 @@ import pickle
 import argparse
 import traceback
 
-from getpass import getpass
+from getpass            import getpass
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(f"{os.getcwd()}/scripts")
 
-from scripts.pacstrap      import tune_pacman, update_pacman, pacstrap
+from scripts.pacstrap      import (
+    tune_pacman,
+    update_pacman,
+    copy_databases,
+    get_packages,
+    get_shell_packages,
+    split_repo_packages,
+    pacstrap,
+    Prefetcher
+)
 from scripts.drive_utils   import Drive, RaidArray
 from scripts.config_utils  import Config
 from scripts.chroot        import Chroot
 from scripts.btrfs         import Btrfs
+from scripts.scheduler     import Scheduler
+from scripts.mount_tree    import MountTree
+from scripts.package_cache import PackageCache
+from scripts.image         import RootImage, get_image_key
+from scripts.hooks         import HookDeferral
+from scripts.luks          import PbkdfCalibration, get_max_parallel
+from scripts.mdstat        import ResyncMonitor, set_speed_limits, restore_speed_limits
 
 import scripts.command_utils as cmd
+import scripts.fstab         as fstab
 import scripts.output_utils  as output
 
 
@@ -30,19 +48,24 @@ class Excalibur:
         5: "Configure New Root"
     }
 
+    # Host independent tasks come first so that the new root can be saved as
+    # an image before anything host specific has been configured
     CHROOT_TASK_KEY = {
-        0: "Configure Clock",
-        1: "Configure Locales",
-        2: "Set Default Hosts",
-        3: "Set Hostname",
-        4: "Configure Users",
-        5: "Configure Crypt",
-        6: "Configure RAID",
-        7: "Enable AUR",
-        8: "Install Packages",
-        9: "Enable Services",
-        10: "Configure Boot",
-        11: "Generate fstab"
+        0: "Configure Locales",
+        1: "Set Default Hosts",
+        2: "Configure Users",
+        3: "Enable AUR",
+        4: "Install Packages",
+        5: "Enable Services",
+        6: "Run Deferred Hooks",
+        7: "Save Root Image",
+        8: "Configure Clock",
+        9: "Set Hostname",
+        10: "Set Passwords",
+        11: "Configure Crypt",
+        12: "Configure RAID",
+        13: "Configure Boot",
+        14: "Generate fstab"
     }
 
     def __init__(self, parser: argparse.ArgumentParser):
@@ -97,6 +120,31 @@ class Excalibur:
         self.root_uuid = ""
         self.root_subvol = None
 
+        # Packages to be installed with the AUR helper after pacstrap
+        self.aur_packages = []
+
+        # Background package downloads, if enabled
+        self.prefetcher = None
+
+        # Background RAID resync tracking and the resync speed limits to
+        # restore once the install is done
+        self.resync_monitor = None
+        self.resync_limits  = {}
+
+        # Whether the new root is extracted from an existing root image
+        self.from_image = False
+
+    #--------------------------------------------------------------------------
+
+    def __getstate__(self) -> dict:
+        # Background work can't be saved with the program state
+        state = self.__dict__.copy()
+        state["prefetcher"]     = None
+        state["resync_monitor"] = None
+        return state
+
+    #--------------------------------------------------------------------------
+
     def __parse_args(self, parser: argparse.ArgumentParser) -> argparse.Namespace:
         parser.add_argument("-Z", "--zap-all",
                             help="Wipe all drives specified in config",
@@ -122,6 +170,27 @@ class Excalibur:
                             action="store",
                             default="/mnt/excalibur")
         
+        parser.add_argument("-j", "--jobs",
+                            help="Maximum number of disk operations to run at once",
+                            dest="JOBS",
+                            metavar="count",
+                            action="store",
+                            type=int,
+                            default=os.cpu_count())
+
+        parser.add_argument("-i", "--image-dir",
+                            help="Install from a root image in this directory, or save one there",
+                            dest="IMAGE_DIR",
+                            metavar="directory",
+                            action="store",
+                            default="")
+
+        parser.add_argument("--unmount",
+                            help="Unmount the new root when finished",
+                            dest="UNMOUNT",
+                            action="store_true",
+                            default=False)
+
         parser.add_argument("--no-partition-drives",
                             help="Skip partitioning drives",
                             dest="PARTITION_DRIVES",
@@ -164,35 +233,6 @@ class Excalibur:
     # Static Methods ----------------------------------------------------------
     #--------------------------------------------------------------------------
 
-    @staticmethod
-    def sort_by_mountpoint(filesystem) -> int:
-        """To be used as a key for sorting by mountpoint length to ensure
-        that filesystems are mounted in the correct order
-        ie. /home should be mounted before /home/bob
-
-        Args:
-            partition (Formattable): _description_
-
-        Returns:
-            int: _description_
-        """
-        # Check for btrfs tuple
-        if type(filesystem[1]) == Btrfs:
-            mountpoint = filesystem[1].get_mountpoint(filesystem[0])
-        else:
-            mountpoint = filesystem[1].mountpoint or None
-        
-        if not mountpoint:
-            return -1
-        elif mountpoint == "/":
-            return 0
-        elif mountpoint == "swap":
-            return -1
-        else:
-            return len(mountpoint.split("/"))
-
-    #--------------------------------------------------------------------------
-
     @staticmethod
     def get_password(message: str, repeat_message: str) -> str:
         passwords_match = False
@@ -333,43 +373,68 @@ class Excalibur:
 
     #--------------------------------------------------------------------------
 
-    def partition_drives(self):
-        for drive in self.config.drives:
-            output.substatus(f"Partitioning drive '{drive}'...")
+    def partition_drive(self, drive: str) -> Drive:
+        output.substatus(f"Partitioning drive '{drive}'...")
 
-            drive_config = self.config.drives[drive]
+        drive_config = self.config.drives[drive]
 
-            device_path = drive_config["device-path"]
-            gpt         = drive_config["gpt"]
+        device_path = drive_config["device-path"]
+        gpt         = drive_config["gpt"]
 
-            self.drives[drive] = Drive(device_path=device_path,
-                                       gpt=gpt)
+        new_drive = Drive(device_path=device_path,
+                          gpt=gpt)
 
-            for uid in drive_config["partitions"]:
-                output.substatus(f"Creating partition '{uid}'...", 2)
+        # Partitions are created in config order so their numbers are stable
+        for uid in drive_config["partitions"]:
+            output.substatus(f"Creating partition '{uid}'...", 2)
 
-                partition_config = drive_config["partitions"][uid]
-
-                self.drives[drive].new_partition(
-                    partition_size  = partition_config["size"],
-                    start_sector    = partition_config["start-sector"],
-                    end_sector      = partition_config["end-sector"],
-                    type_code       = partition_config["type-code"],
-                    partition_label = partition_config["partition-label"],
-                    uid             = uid,
-                    dry_run         = self.dry_run
-                )
+            partition_config = drive_config["partitions"][uid]
 
-                self.devices[uid] = self.drives[drive][uid]
-            
-            output.success(
-                f"Drive '{drive}' has been successfully partitioned!",
-                1
+            new_drive.new_partition(
+                partition_size  = partition_config["size"],
+                start_sector    = partition_config["start-sector"],
+                end_sector      = partition_config["end-sector"],
+                type_code       = partition_config["type-code"],
+                partition_label = partition_config["partition-label"],
+                uid             = uid,
+                dry_run         = self.dry_run
             )
 
+        output.substatus(f"Writing partition table to '{drive}'...", 2)
+        new_drive.write_partition_table(self.dry_run)
+
+        output.success(
+            f"Drive '{drive}' has been successfully partitioned!",
+            1
+        )
+
+        return new_drive
+
+    #--------------------------------------------------------------------------
+
+    def partition_drives(self):
+        # Each drive is partitioned in its own worker since drives don't
+        # depend on each other
+        with ThreadPoolExecutor(max_workers=self.args.JOBS) as pool:
+            new_drives = pool.map(self.partition_drive, self.config.drives)
+
+            # Merge the results back in config order
+            for drive, new_drive in zip(self.config.drives, new_drives):
+                self.drives[drive] = new_drive
+
+                for uid in self.config.drives[drive]["partitions"]:
+                    self.devices[uid] = new_drive[uid]
+
     #--------------------------------------------------------------------------
 
     def setup_raid_arrays(self):
+        # Keep the initial resyncs from starving the rest of the install
+        self.resync_limits = set_speed_limits(
+            self.config.resync["speed-limit-min"],
+            self.config.resync["speed-limit-max"],
+            self.dry_run
+        )
+
         for uid in self.config.raid:
             output.substatus(f"Creating array '{uid}'...")
 
@@ -385,10 +450,13 @@ class Excalibur:
                 raid_array_devices.append(self.devices[raid_device_uid])
             
             self.devices[uid] = RaidArray(
-                devices    = raid_array_devices,
-                array_name = raid_config["array-name"],
-                level      = raid_config["level"],
-                dry_run    = self.dry_run
+                devices      = raid_array_devices,
+                array_name   = raid_config["array-name"],
+                level        = raid_config["level"],
+                dry_run      = self.dry_run,
+                assume_clean = raid_config["assume-clean"],
+                bitmap       = raid_config["bitmap"],
+                chunk_size   = raid_config["chunk-size"]
             )
 
             self.raid_arrays.append(self.devices[uid])
@@ -398,19 +466,87 @@ class Excalibur:
                 1
             )
 
+        # The arrays are usable while they resync, so carry on and only
+        # keep an eye on them
+        self.resync_monitor = ResyncMonitor()
+        self.resync_monitor.start()
+
+    #--------------------------------------------------------------------------
+
+    def finish_resync(self):
+        """Report on any resyncs still running, lift the temporary speed
+        limits and optionally wait for the resyncs to finish
+        """
+        if not self.resync_monitor:
+            self.resync_monitor = ResyncMonitor()
+            self.resync_monitor.start()
+
+        self.resync_monitor.report()
+
+        restore_speed_limits(self.resync_limits, self.dry_run)
+        self.resync_limits = {}
+
+        if self.config.resync["wait"] and not self.dry_run:
+            output.status("Waiting for RAID arrays to finish resyncing...")
+            self.resync_monitor.wait()
+            output.success("RAID arrays are in sync")
+        else:
+            self.resync_monitor.stop()
+
+    #--------------------------------------------------------------------------
+
+    def encrypt_partition(self, uid: str, format_options: str):
+        output.substatus(f"Encrypting device '{uid}'...")
+
+        crypt_config = self.config.crypt[uid]
+
+        self.devices[uid].encrypt_partition(
+            crypt_config["password"],
+            crypt_config["crypt-label"],
+            crypt_config["generate-keyfile"],
+            **{
+                "format-options"     : format_options,
+                "no-read-workqueue"  : crypt_config["no-read-workqueue"],
+                "no-write-workqueue" : crypt_config["no-write-workqueue"],
+                "allow-discards"     : crypt_config["allow-discards"],
+                "sector-size"        : crypt_config["sector-size"],
+                "persistent"         : crypt_config["persistent"]
+            }
+        )
+
     #--------------------------------------------------------------------------
 
     def encrypt_partitions(self):
-        for uid in self.config.crypt:
-            output.substatus(f"Encrypting device '{uid}'...")
+        luks_config = self.config.luks
 
-            crypt_config = self.config.crypt[uid]
+        # Derive the PBKDF cost once up front rather than letting every
+        # luksFormat benchmark on its own while competing with the others
+        if luks_config["calibrate"]:
+            format_options = PbkdfCalibration(
+                luks_config["benchmark-cache"],
+                self.dry_run
+            ).get_format_options(luks_config["unlock-time"], luks_config["pbkdf-memory"])
+        else:
+            format_options = \
+                f"--pbkdf argon2id --pbkdf-memory {luks_config['pbkdf-memory']} " \
+                + f"--iter-time {luks_config['unlock-time']}"
 
-            self.devices[uid].encrypt_partition(
-                crypt_config["password"],
-                crypt_config["crypt-label"],
-                crypt_config["generate-keyfile"]
-            )
+        # argon2id is memory hard, so available memory limits how many
+        # devices can be formatted at once
+        max_workers = get_max_parallel(luks_config["pbkdf-memory"], self.args.JOBS)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(self.encrypt_partition, uid, format_options)
+                for uid in self.config.crypt
+            ]
+
+            # Surface the first failure, if any
+            for future in futures:
+                future.result()
+
+        for uid in self.config.crypt:
+            crypt_config = self.config.crypt[uid]
 
             if "load-early" in crypt_config and crypt_config["load-early"]:
                 if self.early_crypt_device:
@@ -434,18 +570,108 @@ class Excalibur:
 
     #--------------------------------------------------------------------------
 
-    def create_filesystems(self):
-        for uid in self.config.filesystems:
-            filesystem_config = self.config.filesystems[uid]
+    def create_filesystem(self, uid: str):
+        filesystem_config = self.config.filesystems[uid]
 
-            output.substatus(f"Creating filesystem on '{uid}'...")
+        output.substatus(f"Creating filesystem on '{uid}'...")
+
+        self.devices[uid].new_filesystem(
+            filesystem_config["filesystem"],
+            filesystem_config["label"],
+            filesystem_config["mountpoint"],
+            mount_options = filesystem_config["mount-options"],
+            swap_priority = filesystem_config["swap-priority"]
+        )
+
+        output.success(
+            f"Device '{uid}' has been successfully formatted!",
+            1
+        )
 
-            self.devices[uid].new_filesystem(
-                filesystem_config["filesystem"],
-                filesystem_config["label"],
-                filesystem_config["mountpoint"]
+    #--------------------------------------------------------------------------
+
+    def create_btrfs(self, btrfs_uid: str) -> Btrfs:
+        btrfs_config = self.config.btrfs[btrfs_uid]
+
+        output.substatus(f"Creating btrfs filesystem '{btrfs_uid}'...")
+
+        btrfs_devices = []
+        for uid in btrfs_config["devices"]:
+            btrfs_devices.append(self.devices[uid])
+            
+        btrfs = Btrfs(
+            btrfs_devices,
+            btrfs_config["data-raid"],
+            btrfs_config["metadata-raid"],
+            btrfs_config["label"],
+            btrfs_config["options"],
+            self.dry_run
+        )
+
+        # Each filesystem gets its own temporary mountpoint since several
+        # of them may be set up at the same time
+        temporary_mountpoint = f"{self.target}/btrfs-{btrfs_uid}"
+        
+        cmd.execute(
+            f"mount -m /dev/disk/by-uuid/{btrfs.uuid} {temporary_mountpoint}",
+            dry_run=self.dry_run
+        )
+        
+        for subvol in btrfs_config["subvolumes"]:
+            subvol_config = btrfs_config["subvolumes"][subvol]
+            
+            btrfs.create_subvolume(
+                subvol,
+                subvol_config["mountpoint"],
+                subvol_config["compression"],
+                subvol_config["options"],
+                temporary_mountpoint
             )
             
+        cmd.execute(f"umount {temporary_mountpoint}", dry_run=self.dry_run)
+        cmd.execute(f"rmdir {temporary_mountpoint}", dry_run=self.dry_run)
+
+        output.success(
+            f"Btrfs filesystem '{btrfs_uid}' has been successfully created!",
+            1
+        )
+
+        return btrfs
+
+    #--------------------------------------------------------------------------
+
+    def create_filesystems(self):
+        scheduler = Scheduler(self.args.JOBS)
+
+        # The partitions, arrays and encrypted devices underneath were all
+        # made by the earlier phases, so filesystems don't depend on each
+        # other. Only jobs that share a physical drive are kept apart
+        for uid in self.config.filesystems:
+            scheduler.add(
+                uid,
+                lambda uid=uid: self.create_filesystem(uid),
+                (),
+                self.devices[uid].spindles
+            )
+
+        for btrfs_uid in self.config.btrfs:
+            spindles = set()
+            for uid in self.config.btrfs[btrfs_uid]["devices"]:
+                spindles |= self.devices[uid].spindles
+
+            scheduler.add(
+                btrfs_uid,
+                lambda btrfs_uid=btrfs_uid: self.create_btrfs(btrfs_uid),
+                (),
+                spindles
+            )
+
+        results = scheduler.run()
+
+        # Merge the results back in config order
+        for uid in self.config.filesystems:
+            filesystem_config = self.config.filesystems[uid]
+
             # If the filesystem is efi, set its mountpoint as the efi directory
             if filesystem_config["filesystem"] == "efi":
                 self.efi_device = self.devices[uid]
@@ -454,93 +680,233 @@ class Excalibur:
             if filesystem_config["mountpoint"] == "/":
                 self.root_uuid = self.devices[uid].uuid
 
-            output.success(
-                f"Device '{uid}' has been successfully formatted!",
-                1
-            )
-
         for btrfs_uid in self.config.btrfs:
-            btrfs_config = self.config.btrfs[btrfs_uid]
-            
-            btrfs_devices = []
-            for uid in btrfs_config["devices"]:
-                btrfs_devices.append(self.devices[uid])
-                
-            self.devices[btrfs_uid] = Btrfs(
-                btrfs_devices,
-                btrfs_config["data-raid"],
-                btrfs_config["metadata-raid"],
-                btrfs_config["label"],
-                btrfs_config["options"],
-                self.dry_run
-            )
-            
-            cmd.execute(
-                f"mount -m /dev/disk/by-uuid/{self.devices[btrfs_uid].uuid} " \
-                    + f"{self.target}/btrfs",
-                dry_run=self.dry_run
-            )
-            
-            for subvol in btrfs_config["subvolumes"]:
-                subvol_config = btrfs_config["subvolumes"][subvol]
-                
-                self.devices[btrfs_uid].create_subvolume(
-                    subvol,
-                    subvol_config["mountpoint"],
-                    subvol_config["compression"],
-                    subvol_config["options"],
-                    f"{self.target}/btrfs"
-                )
-                
+            self.devices[btrfs_uid] = results[btrfs_uid]
+
+            for subvol, subvol_config in self.config.btrfs[btrfs_uid]["subvolumes"].items():
                 self.devices[subvol] = self.devices[btrfs_uid]
                 
                 if subvol_config["mountpoint"] == "/":
                     self.root_subvol = subvol
                     self.root_uuid = self.devices[btrfs_uid].uuid
-                
-            cmd.execute(f"umount {self.target}/btrfs", dry_run=self.dry_run)
-            
-        cmd.execute(f"rmdir {self.target}/btrfs", dry_run=self.dry_run)
-                
-        # Sort mountable devices by their mountpoints 
-        self.devices = dict(
-            sorted(
-                self.devices.items(),
-                key=self.sort_by_mountpoint
-            )
-        )
+
+    #--------------------------------------------------------------------------
+
+    def build_mount_tree(self) -> MountTree:
+        mount_tree = MountTree()
+
+        for uid, device in self.devices.items():
+            if type(device) is Btrfs:
+                if mountpoint := device.get_mountpoint(uid):
+                    mount_tree.add(
+                        mountpoint,
+                        lambda device=device, uid=uid: device.mount_subvolume(uid, self.target),
+                        lambda device=device, uid=uid: device.unmount_subvolume(uid, self.target),
+                        (device, uid)
+                    )
+            elif device.filesystem not in (None, "swap", "btrfs_") and device.mountpoint:
+                mount_tree.add(
+                    device.mountpoint,
+                    lambda device=device: device.mount_filesystem(self.target),
+                    lambda device=device: device.unmount_filesystem(self.target),
+                    device
+                )
+
+        return mount_tree
+
+    #--------------------------------------------------------------------------
+
+    def swap_devices(self) -> list:
+        return [
+            device for device in self.devices.values()
+            if type(device) is not Btrfs and device.filesystem == "swap"
+        ]
 
     #--------------------------------------------------------------------------
 
     def mount_filesystems(self):
-        for uid in self.devices:
-            if type(self.devices[uid]) is Btrfs:
-                self.devices[uid].mount_subvolume(uid, self.target)
-            else:
-                self.devices[uid].mount_filesystem(self.target)
+        self.build_mount_tree().mount(self.args.JOBS)
+
+        for device in self.swap_devices():
+            device.mount_filesystem(self.target)
+
+    #--------------------------------------------------------------------------
+
+    def unmount_filesystems(self):
+        for device in self.swap_devices():
+            device.unmount_filesystem(self.target)
+
+        self.build_mount_tree().unmount(self.args.JOBS)
 
     #--------------------------------------------------------------------------
     # Pacstrap Method to Make the New Root Usable -----------------------------
     #--------------------------------------------------------------------------
 
-    def bootstrap_newroot(self):
-        # Tune pacman in the live environment
-        if not self.dry_run:
-            tune_pacman()
+    def get_package_cache(self) -> PackageCache | None:
+        if not self.config.pacman["cache-directory"]:
+            return None
 
-        update_pacman(self.dry_run)
+        return PackageCache(
+            self.config.pacman["cache-directory"],
+            self.config.pacman["cache-max-size"],
+            self.config.pacman["cache-max-age"],
+            self.dry_run
+        )
 
-        pacstrap(
+    #--------------------------------------------------------------------------
+
+    def get_deferred_hooks(self) -> HookDeferral:
+        return HookDeferral(
             self.target,
+            self.config.pacman["deferred-hooks"],
+            self.dry_run
+        )
+
+    #--------------------------------------------------------------------------
+
+    def get_package_set(self) -> list:
+        """Collect every package the new root needs so they can all be
+        installed in a single pacstrap transaction
+
+        Returns:
+            list: The package names without duplicates
+        """
+        packages = get_packages(
             self.config.kernel,
             self.config.firmware,
             self.config.boot["bootloader"],
             self.config.boot["efi"],
             self.config.networkmanager,
             self.config.ssh,
-            self.config.reflector,
+            self.config.reflector
+        )
+
+        packages += self.config.packages
+
+        packages += get_shell_packages(
+            [self.config.users[user]["shell"] for user in self.config.users]
+        )
+
+        if self.config.raid:
+            packages.append("mdadm")
+
+        # Needed to clone the AUR helper
+        if self.config.aur_helper:
+            packages.append("git")
+
+        return list(dict.fromkeys(packages))
+
+    #--------------------------------------------------------------------------
+
+    def get_units(self) -> list:
+        """Collect every systemd unit that should be enabled in the new root
+        so that they can all be enabled at once
+
+        Returns:
+            list: The unit names without duplicates
+        """
+        units = list(self.config.services)
+
+        if self.config.clock["enable-ntp"]:
+            units.append("systemd-timesyncd.service")
+
+        if self.config.networkmanager:
+            units.append("NetworkManager.service")
+
+        if self.config.ssh:
+            units.append("sshd.service")
+
+        if self.config.reflector:
+            units.append("reflector.timer")
+
+        return list(dict.fromkeys(units))
+
+    #--------------------------------------------------------------------------
+
+    def get_root_image(self) -> RootImage:
+        # Only what ends up in the image is hashed, so that the image is
+        # rebuilt when and only when one of those parts of the config changes
+        users = {
+            user : {key: value for key, value in user_config.items() if key != "password"}
+            for user, user_config in self.config.users.items()
+        }
+
+        key = get_image_key({
+            "packages"   : self.get_package_set(),
+            "aur-helper" : self.config.aur_helper,
+            "locales"    : self.config.locales,
+            "users"      : users,
+            "units"      : self.get_units()
+        })
+
+        return RootImage(self.args.IMAGE_DIR, key, self.dry_run)
+
+    #--------------------------------------------------------------------------
+
+    def start_prefetch(self):
+        """Start downloading every package into the cache while the drives
+        are being prepared
+        """
+        package_cache = self.get_package_cache()
+        if not package_cache or not self.config.pacman["prefetch"]:
+            return
+
+        # Tune pacman in the live environment
+        if not self.dry_run:
+            tune_pacman()
+
+        package_cache.prepare()
+
+        output.info("Prefetching packages in the background...")
+        self.prefetcher = Prefetcher(
+            self.get_package_set(),
+            package_cache.directory,
+            self.config.pacman["sync-ttl"],
             self.dry_run
         )
+        self.prefetcher.start()
+
+    #--------------------------------------------------------------------------
+
+    def bootstrap_newroot(self):
+        if self.prefetcher:
+            output.substatus("Waiting for prefetched packages...")
+            self.prefetcher.wait()
+        else:
+            # Tune pacman in the live environment
+            if not self.dry_run:
+                tune_pacman()
+
+            update_pacman(self.dry_run, self.config.pacman["sync-ttl"])
+
+        # Reuse the databases that were just synced in the live environment
+        copy_databases(self.target, self.dry_run)
+
+        if package_cache := self.get_package_cache():
+            package_cache.prepare()
+
+        packages = self.get_package_set()
+
+        # Packages that aren't in the repos are left for the AUR helper
+        if self.config.aur_helper:
+            packages, self.aur_packages = split_repo_packages(packages, self.dry_run)
+
+        # Expensive hooks are masked from the very first transaction
+        deferred_hooks = self.get_deferred_hooks()
+        deferred_hooks.mask()
+
+        # The chroot masks them again for its own transactions, but they must
+        # never be left behind if the chroot is skipped or never reached
+        try:
+            pacstrap(
+                self.target,
+                packages,
+                package_cache.directory if package_cache else "",
+                deferred_hooks.override_dir,
+                self.dry_run
+            )
+        finally:
+            deferred_hooks.restore()
 
         # Tune pacman in the new target environment
         tune_pacman(self.target)
@@ -550,12 +916,34 @@ class Excalibur:
     #--------------------------------------------------------------------------
 
     def run(self):
+        try:
+            self.install()
+        finally:
+            # The host's resync throttling must not stay changed if the
+            # install fails before the resyncs are finished with
+            restore_speed_limits(self.resync_limits, self.dry_run)
+            self.resync_limits = {}
+
+    #--------------------------------------------------------------------------
+
+    def install(self):
         output.info("Running...")
 
         if not self.dry_run:
             self.collect_crypt_passwords()
             self.collect_user_passwords()
 
+        if self.args.IMAGE_DIR and 4 not in self.status:
+            self.from_image = self.get_root_image().exists()
+
+            if self.from_image:
+                output.info(f"Installing from root image {self.get_root_image().path}")
+            else:
+                output.info(f"Root image will be saved to {self.get_root_image().path}")
+
+        if self.args.PACSTRAP and not self.from_image and 4 not in self.status:
+            self.start_prefetch()
+
         if self.config.drives and self.args.PARTITION_DRIVES and 0 not in self.status:
             if not self.confirm_partitions():
                 output.info("Aborting...")
@@ -603,9 +991,14 @@ class Excalibur:
         if self.args.PACSTRAP and 4 not in self.status:
             self.start_task(4)
 
-            output.status("Bootstrapping the new root...")
-            self.bootstrap_newroot()
-            output.success("New root sucessfully bootstrapped")
+            if self.from_image:
+                output.status("Extracting the root image...")
+                self.get_root_image().extract(self.target)
+                output.success("Root image successfully extracted")
+            else:
+                output.status("Bootstrapping the new root...")
+                self.bootstrap_newroot()
+                output.success("New root sucessfully bootstrapped")
 
             self.finish_task(4)
 
@@ -613,127 +1006,188 @@ class Excalibur:
             self.start_task(5)
 
             output.status("Creating chroot environment...")
-            with Chroot(self.target, self.dry_run, self.efi_device.mountpoint) as chroot_env:
-
-                if 0 not in self.chroot_status:
+            with Chroot(
+                self.target,
+                self.dry_run,
+                self.efi_device.mountpoint,
+                package_cache=self.get_package_cache(),
+                deferred_hooks=self.get_deferred_hooks(),
+                initramfs_profile=self.config.initramfs["profile"]
+            ) as chroot_env:
+
+                # Host independent steps, these are already part of a root image
+
+                if not self.from_image and 0 not in self.chroot_status:
                     self.start_task(0, True)
 
-                    output.substatus("Configuring clock...")
-                    chroot_env.configure_clock(
-                        self.config.clock["timezone"],
-                        self.config.clock["hardware-utc"],
-                        self.config.clock["enable-ntp"]
+                    output.substatus("Configuring locales...")
+                    chroot_env.configure_locales(
+                        self.config.locales["locale-gen"],
+                        self.config.locales["locale-conf"],
+                        self.config.locales["locale-archive"],
+                        self.args.JOBS
                     )
 
                     self.finish_task(0, True)
 
-                if 1 not in self.chroot_status:
+                if not self.from_image and 1 not in self.chroot_status:
                     self.start_task(1, True)
 
-                    output.substatus("Configuring locales...")
-                    chroot_env.configure_locales(
-                        self.config.locales["locale-gen"],
-                        self.config.locales["locale-conf"]
-                    )
+                    output.info("Set default /etc/hosts", 1)
+                    chroot_env.configure_hosts()
 
                     self.finish_task(1, True)
 
-                if 2 not in self.chroot_status:
+                if not self.from_image and 2 not in self.chroot_status:
                     self.start_task(2, True)
 
-                    output.info("Set default /etc/hosts", 1)
-                    chroot_env.configure_hosts()
+                    output.substatus("Configuring users...")
+                    chroot_env.configure_users(self.config.users)
 
                     self.finish_task(2, True)
 
-                if 3 not in self.chroot_status:
+                if not self.from_image and self.config.aur_helper and 3 not in self.chroot_status:
                     self.start_task(3, True)
 
-                    output.info(f"Set default hostname to {self.config.hostname}", 1)
-                    chroot_env.set_hostname(self.config.hostname)
+                    output.substatus("Configuring AUR...")
+                    chroot_env.enable_aur(self.config.aur_helper)
 
                     self.finish_task(3, True)
 
-                if 4 not in self.chroot_status:
+                if not self.from_image and self.aur_packages and 4 not in self.chroot_status:
                     self.start_task(4, True)
 
-                    output.substatus("Configuring users...")
-                    output.info("Set root password", 2)
-                    chroot_env.set_root_password(self.root_password)
-
-                    for user in self.config.users:
-                        output.substatus(f"Configuring user {user}...", 2)
-                        user_config = self.config.users[user]
-
-                        chroot_env.configure_user(
-                            user,
-                            user_config["shell"],
-                            user_config["home"],
-                            user_config["comment"],
-                            user_config["groups"],
-                            user_config["sudo"],
-                            user_config["password"]
-                        )
+                    output.substatus("Installing AUR packages...")
+                    chroot_env.install_packages(
+                        self.aur_packages,
+                        self.config.pacman["sync-ttl"]
+                    )
 
                     self.finish_task(4, True)
 
-                if self.config.crypt and 5 not in self.chroot_status:
+                if not self.from_image and self.get_units() and 5 not in self.chroot_status:
                     self.start_task(5, True)
 
-                    output.substatus("Configuring encrypted devices...")
-                    if self.early_crypt_device:
-                        output.info(f"Configuring device {self.early_crypt_device.encrypt_label} to decrypt in early userspace", 1)
-                        chroot_env.configure_early_crypt(self.early_crypt_device)
-                    for crypt_dev in self.late_crypt_devices:
-                        chroot_env.configure_late_crypt(crypt_dev)
+                    output.substatus("Enabling services...")
+                    chroot_env.enable_services(self.get_units())
 
                     self.finish_task(5, True)
 
-                if self.config.raid and 6 not in self.chroot_status:
+                # Everything is installed by now, so the deferred hooks see
+                # every package and their output ends up in the image and
+                # in the initramfs
+                if not self.from_image and 6 not in self.chroot_status:
                     self.start_task(6, True)
-                    
-                    output.substatus("Configure RAID arrays...")
-                    chroot_env.configure_raid()
+
+                    output.substatus("Running deferred pacman hooks...")
+                    chroot_env.run_deferred_hooks()
 
                     self.finish_task(6, True)
 
-                if self.config.aur_helper and 7 not in self.chroot_status:
+                if not self.from_image and self.args.IMAGE_DIR and 7 not in self.chroot_status:
                     self.start_task(7, True)
 
-                    output.substatus("Configuring AUR...")
-                    chroot_env.enable_aur(self.config.aur_helper)
+                    # Hosts installed from the image never set up the AUR
+                    # helper, so they would never get rid of its build user
+                    if self.config.aur_helper:
+                        chroot_env.remove_aur_builder()
+
+                    output.substatus("Saving root image...")
+                    self.get_root_image().build(
+                        self.target,
+                        chroot_env.deferred_hooks.masks
+                    )
 
                     self.finish_task(7, True)
 
-                if self.config.packages and 8 not in self.chroot_status:
+                # Host specific steps, these always run
+
+                if 8 not in self.chroot_status:
                     self.start_task(8, True)
 
-                    output.substatus("Installing packages...")
-                    chroot_env.install_packages(self.config.packages)
+                    output.substatus("Configuring clock...")
+                    chroot_env.configure_clock(
+                        self.config.clock["timezone"],
+                        self.config.clock["hardware-utc"]
+                    )
 
                     self.finish_task(8, True)
 
-                if self.config.services and 9 not in self.chroot_status:
+                if 9 not in self.chroot_status:
                     self.start_task(9, True)
 
-                    output.substatus("Enabling services...")
-                    chroot_env.enable_services(self.config.services)
+                    output.info(f"Set default hostname to {self.config.hostname}", 1)
+                    chroot_env.set_hostname(self.config.hostname)
 
                     self.finish_task(9, True)
-                    
+
                 if 10 not in self.chroot_status:
                     self.start_task(10, True)
+
+                    output.substatus("Setting passwords...")
+
+                    passwords = {"root": self.root_password}
+                    for user in self.config.users:
+                        passwords[user] = self.config.users[user]["password"]
+
+                    chroot_env.set_passwords(passwords)
+
+                    self.finish_task(10, True)
+
+                if self.config.crypt and 11 not in self.chroot_status:
+                    self.start_task(11, True)
+
+                    output.substatus("Configuring encrypted devices...")
+                    if self.early_crypt_device:
+                        output.info(f"Configuring device {self.early_crypt_device.encrypt_label} to decrypt in early userspace", 1)
+                        chroot_env.configure_early_crypt(self.early_crypt_device)
+                    for crypt_dev in self.late_crypt_devices:
+                        chroot_env.configure_late_crypt(crypt_dev)
+
+                    self.finish_task(11, True)
+
+                if self.config.raid and 12 not in self.chroot_status:
+                    self.start_task(12, True)
+                    
+                    output.substatus("Configure RAID arrays...")
+                    chroot_env.configure_raid()
+
+                    self.finish_task(12, True)
+                    
+                if 13 not in self.chroot_status:
+                    self.start_task(13, True)
                     
                     output.substatus("Configuring boot...")
                     
-                    if self.config.boot["bootloader"] == "efistub":
+                    efistub = self.config.boot["bootloader"] == "efistub"
+
+                    if efistub:
                         chroot_env.set_default_kernel_params(
                             self.root_uuid,
                             self.root_subvol
                         )
-                        
-                        chroot_env.generate_ukis()
-                        
+
+                    # The initcpio hook was masked for every transaction, so
+                    # the kernels are only put in place now
+                    chroot_env.install_kernels()
+
+                    # Hooks and the kernel cmdline are final by now, so every
+                    # image is built exactly once
+                    chroot_env.configure_initramfs(
+                        self.config.initramfs["compression"],
+                        self.config.initramfs["compression-level"],
+                        self.config.initramfs["modules-decompress"]
+                    )
+                    chroot_env.configure_presets(
+                        self.config.initramfs["fallback"],
+                        uki=efistub
+                    )
+                    chroot_env.generate_initramfs(
+                        self.config.kernel,
+                        self.config.initramfs["all-presets"]
+                    )
+
+                    if efistub:
                         chroot_env.configure_efistub(
                             self.efi_device.partition_path[:-1], # Assumes there are no more than 9 partitions
                             self.efi_device.partition_path[-1],  #
@@ -741,19 +1195,33 @@ class Excalibur:
                             self.config.kernel
                         )
                         
-                    self.finish_task(10, True)
+                    self.finish_task(13, True)
                     
-                if 11 not in self.chroot_status:
-                    self.start_task(11, True)
+                if 14 not in self.chroot_status:
+                    self.start_task(14, True)
                     
                     output.substatus("Generating fstab...")
                     
-                    chroot_env.generate_fstab()
+                    chroot_env.generate_fstab(
+                        fstab.generate(self.build_mount_tree(), self.swap_devices())
+                    )
                     
-                    self.finish_task(11, True)
+                    self.finish_task(14, True)
 
             self.finish_task(5)
 
+        if self.config.raid:
+            self.finish_resync()
+
+        # Keep the shared package cache from growing without bounds
+        if package_cache := self.get_package_cache():
+            package_cache.prune()
+
+        if self.args.UNMOUNT:
+            output.status("Unmounting filesystems...")
+            self.unmount_filesystems()
+            output.success("Filesystems successfully unmounted!")
+
 #------------------------------------------------------------------------------
 
 # EOF
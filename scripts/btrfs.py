@@ -1,7 +1,10 @@
 import command_utils as cmd
 import output_utils as output
 
-from drive_utils import Formattable
+from drive_utils  import Formattable
+from device_cache import blkid_cache
+from device_wait  import wait_for_devices
+from fstab        import get_mount_options
 
 
 class Btrfs:
@@ -33,11 +36,16 @@ class Btrfs:
             mkfs_command += f" {device.partition_path}"
 
         cmd.execute(mkfs_command, dry_run=dry_run)
+        blkid_cache.invalidate()
 
         for device in devices:
             device.set_as_btrfs_device(label)
         
         self.uuid = devices[0].uuid
+
+        # The filesystem is mounted by UUID right after it has been created
+        wait_for_devices([f"/dev/disk/by-uuid/{self.uuid}"], dry_run=dry_run)
+
         self.devices = devices
         self.label = label
         
@@ -93,6 +101,20 @@ class Btrfs:
             return None
             
     #--------------------------------------------------------------------------
+
+    def get_mount_options(self, subvolume_path: str) -> list:
+        subvol = self.subvolumes[subvolume_path]
+
+        mount_options = [f"subvol={subvolume_path}"]
+
+        if compress := subvol["compression"]:
+            mount_options.append(f"compress={compress}")
+
+        mount_options += get_mount_options("btrfs", subvol["mount-options"])
+
+        return mount_options
+            
+    #--------------------------------------------------------------------------
             
     def mount_subvolume(
         self,
@@ -103,21 +125,26 @@ class Btrfs:
         if not self.get_mountpoint(subvolume_path):
             return
         
-        subvol = self.subvolumes[subvolume_path]
-        
-        mount_command = f"mount -m -o subvol={subvolume_path}"
-        
-        if compress := subvol["compression"]:
-            mount_command += f",compress={compress}"
-        
-        if options := subvol["mount-options"]:
-            mount_command += f",{','.join(options)}"
+        mount_command = f"mount -m -o {','.join(self.get_mount_options(subvolume_path))}"
             
         mount_command += f" /dev/disk/by-uuid/{self.uuid}"
         
         mount_command += f" {override_mount}{self.get_mountpoint(subvolume_path)}"
         
         cmd.execute(mount_command, dry_run=self.dry_run)
+
+    #--------------------------------------------------------------------------
+
+    def unmount_subvolume(
+        self,
+        subvolume_path: str,
+        override_mount: str
+    ):
+
+        if not (mountpoint := self.get_mountpoint(subvolume_path)):
+            return
+
+        cmd.execute(f"umount {override_mount}{mountpoint}", dry_run=self.dry_run)
         
     #--------------------------------------------------------------------------    
     
@@ -4,6 +4,7 @@ from re import (
 )
 
 from typing import Union
+from shlex  import quote
 from os import listdir
 import subprocess
 
@@ -11,7 +12,102 @@ import command_utils as cmd
 import output_utils  as output
 
 from command_utils import PipeOpts
-from drive_utils import Formattable
+from chroot_shell  import ChrootShell
+from package_cache import PackageCache
+from pacstrap      import get_database_age
+from drive_utils   import Formattable
+from hooks         import HookDeferral
+from luks          import install_keyfile
+
+# ------------------------------------------------------------------------------
+
+# mkinitcpio compressor for each compression option
+COMPRESSORS = {
+    "zstd" : "zstd",
+    "lz4"  : "lz4",
+    "none" : "cat"
+}
+
+# Hooks and kernel parameters as each initramfs profile spells them, hooks are
+# referred to by the generic names on the left
+INITRAMFS_PROFILES = {
+    "busybox" : {
+        "hooks" : {
+            "udev"     : ["udev"],
+            "vconsole" : ["keymap", "consolefont"],
+            "encrypt"  : ["encrypt"]
+        },
+        "crypt-parameter" : "cryptdevice=UUID={uuid}:{name}",
+        "crypt-options-parameter" : "cryptdevice=UUID={uuid}:{name}:{options}",
+        "crypt-options" : {
+            "discard" : "allow-discards"
+        }
+    },
+    "systemd" : {
+        "hooks" : {
+            "udev"     : ["systemd"],
+            "vconsole" : ["sd-vconsole"],
+            "encrypt"  : ["sd-encrypt"]
+        },
+        "crypt-parameter" : "rd.luks.name={uuid}={name}",
+        "crypt-options-parameter" : "rd.luks.name={uuid}={name} rd.luks.options={uuid}={options}",
+        "crypt-options" : {}
+    }
+}
+
+# Every profile specific hook name mapped back to its generic name
+HOOK_ALIASES = {
+    hook : generic
+    for profile in INITRAMFS_PROFILES.values()
+    for generic, hooks in profile["hooks"].items()
+    for hook in hooks
+}
+
+# Where compiled locales and the locale archive live
+LOCALE_DIR = "/usr/lib/locale"
+
+# ------------------------------------------------------------------------------
+
+def get_locale_input(name: str) -> str:
+    """Get the locale source file for a locale name the same way locale-gen does,
+    by dropping the charset and keeping any modifier
+
+    Args:
+        name (str): Locale name such as en_US.UTF-8 or de_DE@euro
+
+    Returns:
+        str: The name of the source file in /usr/share/i18n/locales
+    """
+    base, _, modifier = name.partition("@")
+    locale_input = base.split(".")[0]
+
+    return f"{locale_input}@{modifier}" if modifier else locale_input
+
+# ------------------------------------------------------------------------------
+
+def get_locale_directory(name: str) -> str:
+    """Get the directory localedef compiles a locale into, which uses the
+    normalized codeset, e.g. en_US.UTF-8 becomes en_US.utf8
+
+    Args:
+        name (str): Locale name
+
+    Returns:
+        str: The directory name inside /usr/lib/locale
+    """
+    base, _, modifier = name.partition("@")
+    language, _, codeset = base.partition(".")
+
+    if codeset:
+        codeset = "".join(char.lower() for char in codeset if char.isalnum())
+
+        # Purely numeric codesets are ISO standards
+        if codeset.isdigit():
+            codeset = f"iso{codeset}"
+
+        language += f".{codeset}"
+
+    return f"{language}@{modifier}" if modifier else language
 
 # ------------------------------------------------------------------------------
 
@@ -21,7 +117,11 @@ class Chroot:
         self,
         target_mountpoint: str,
         dry_run          : bool,
-        efi_directory    : str
+        efi_directory    : str,
+        persistent_shell : bool = True,
+        package_cache    : PackageCache | None = None,
+        deferred_hooks   : HookDeferral | None = None,
+        initramfs_profile: str = "busybox"
     ):
 
         def mount(options: str, dir: str):
@@ -41,26 +141,32 @@ class Chroot:
         # Mount EFI variables for UEFI bootloader configuration
         mount("--rbind /sys/firmware/efi/efivars", "/sys/firmware/efi/efivars")
 
+        # Share the host's package cache so nothing is downloaded twice
+        if package_cache:
+            package_cache.bind(target_mountpoint)
+
         # Copy DNS details to new root
         cmd.execute(
             f"cp /etc/resolv.conf {target_mountpoint}/etc/resolv.conf",
             dry_run=dry_run
         )
 
-        # Temporarily override pacman initcpio hook so that it isn't run multiple times
-        cmd.execute(
-            f"mkdir -p {target_mountpoint}/etc/pacman.d/hooks",
-            dry_run=dry_run
-        )
-        cmd.execute(
-            f"touch {target_mountpoint}/etc/pacman.d/hooks/90-mkinitcpio-install.hook",
-            dry_run=dry_run
-        )
+        # Temporarily override expensive pacman hooks, including the initcpio
+        # hook, so that they aren't run after every transaction
+        self.deferred_hooks = deferred_hooks or HookDeferral(target_mountpoint, [], dry_run)
+        self.deferred_hooks.mask()
 
         self.target    = target_mountpoint
         self.dry_run   = dry_run
         self.installer = "pacman"
         self.efi_dir   = efi_directory
+        self.profile   = INITRAMFS_PROFILES[initramfs_profile]
+
+        self.package_cache = package_cache
+
+        # Stream commands into a single long-lived shell inside the new root
+        # rather than spawning a new chroot process for each of them
+        self.shell = ChrootShell(target_mountpoint, dry_run) if persistent_shell else None
 
         self.system_groups     = self.__get_groups()
 
@@ -77,6 +183,7 @@ class Chroot:
         pipe_mode    : int = PipeOpts.STDIN | PipeOpts.STDOUT,
         wait_for_proc: bool = True, 
         user         : str  = "",
+        input        : str | None = None,
         \
     ):
         """Execute a command in the chroot environment
@@ -85,23 +192,76 @@ class Chroot:
             command (str): Command to be executed
             pipe_mode (int, optional): Octal code to specify which data streams to set to subprocess.PIPE. Defaults to 3.
             wait_for_proc (bool, optional): Whether or not to wait for the command to finish executing. Defaults to True.
+            user (str, optional): Run the command as this user. Defaults to "".
+            input (str, optional): Text to pass to the command's stdin. Defaults to None.
 
         Returns:
             tuple: If wait_for_proc is True
-            subprocess.Popen: If wait_for_proc is False
+            subprocess.Popen: If wait_for_proc is False and the persistent shell is not used
         """
+        if self.shell and wait_for_proc:
+            result = self.shell.run(command, user, input)
+            if result:
+                return result[1:]
+            return
+
         if user:
-            full_command = f"chroot {self.target} su {user} -c '{command}'"
+            full_command = f"chroot {self.target} su {user} -c {quote(command)}"
         else:
-            full_command = f"chroot {self.target} sh -c '{command}'"
+            full_command = f"chroot {self.target} sh -c {quote(command)}"
+
+        if input is None:
+            return cmd.execute(
+                full_command,
+                pipe_mode,
+                self.dry_run,
+                wait_for_proc
+            )
 
-        return cmd.execute(
+        proc = cmd.execute(
             full_command,
-            pipe_mode,
+            pipe_mode | PipeOpts.STDIN,
             self.dry_run,
-            wait_for_proc
+            False
         )
 
+        if isinstance(proc, subprocess.Popen):
+            return proc.communicate(input.encode())
+
+    # --------------------------------------------------------------------------
+
+    def __profile_hooks(self, hook: str) -> list:
+        """Get the names the initramfs profile uses for a hook
+
+        Args:
+            hook (str): Hook name in any profile
+
+        Returns:
+            list: The hook names to use in this profile
+        """
+        return self.profile["hooks"].get(HOOK_ALIASES.get(hook, hook), [hook])
+
+    # --------------------------------------------------------------------------
+
+    def __apply_hook_profile(self):
+        """Rewrite the HOOKS array in /etc/mkinitcpio.conf for the initramfs profile
+        """
+        with open(f"{self.target}/etc/mkinitcpio.conf", "r") as initrd_conf_file:
+            initrd_conf = initrd_conf_file.read()
+
+        def rewrite(hooks_match) -> str:
+            hooks = []
+            for hook in hooks_match.group(1).split():
+                hooks += self.__profile_hooks(hook)
+
+            # keymap and consolefont both become sd-vconsole
+            return f"\nHOOKS=({' '.join(dict.fromkeys(hooks))})"
+
+        initrd_conf = resub(r'\nHOOKS=\(([^)]*)\)', rewrite, initrd_conf)
+
+        with open(f"{self.target}/etc/mkinitcpio.conf", "w") as initrd_conf_file:
+            initrd_conf_file.write(initrd_conf)
+
     # --------------------------------------------------------------------------
 
     def __add_hook(self, preceding_hook: str, hook: str):
@@ -109,7 +269,7 @@ class Chroot:
 
         Args:
             preceding_hook (str): The hook directly before the hook to be added
-            hook (str): The actual hook to be added
+            hook (str): The actual hook to be added, named as in any profile
         """
 
         with open(f"{self.target}/etc/mkinitcpio.conf", "r") as initrd_conf_file:
@@ -117,7 +277,7 @@ class Chroot:
 
         initrd_conf = resub(
             rf'\nHOOKS=\(.*{preceding_hook}',
-            rf'\g<0> {hook}',
+            rf'\g<0> {" ".join(self.__profile_hooks(hook))}',
             initrd_conf
         )
 
@@ -156,6 +316,27 @@ class Chroot:
 
     # --------------------------------------------------------------------------
 
+    def __batch(self, commands: dict) -> str:
+        """Join commands into one script that runs every one of them even if
+        some fail, reporting each failure on its own
+
+        Args:
+            commands (dict): Commands keyed by a description of what they do
+
+        Returns:
+            str: The script, which exits non-zero if any command failed
+        """
+        script = ["status=0"]
+        for description, command in commands.items():
+            script.append(
+                f"{command} || {{ echo {quote(f'Failed to {description}')} >&2; status=1; }}"
+            )
+        script.append("exit $status")
+
+        return "; ".join(script)
+
+    # --------------------------------------------------------------------------
+
     def __get_groups(self):
         groups = []
         with open(f"{self.target}/etc/group", "r") as groups_file:
@@ -169,8 +350,7 @@ class Chroot:
     def configure_clock(
         self,
         timezone    : str,
-        hardware_utc: bool,
-        enable_ntp  : bool
+        hardware_utc: bool
     ):
 
         # Create a symlink from the timezone file to /etc/localtime
@@ -185,17 +365,25 @@ class Chroot:
             f"hwclock --systohc {'--utc' if hardware_utc else ''}"
         )
 
-        # Enable systemd-timesyncd if desired
-        if enable_ntp:
-            self.__wrap_chroot("systemctl enable systemd-timesyncd")
-
     # --------------------------------------------------------------------------
 
     def configure_locales(
         self,
-        locale_gen : list,
-        locale_conf: str
+        locale_gen    : list,
+        locale_conf   : str,
+        locale_archive: str = "append",
+        max_jobs      : int | None = None
     ):
+        """Compile the requested locales concurrently
+
+        Args:
+            locale_gen (list): Lines as they appear in /etc/locale.gen
+            locale_conf (str): The locale to set LANG to
+            locale_archive (str, optional): "append" to add the locales to the
+            locale archive, "minimal" to replace the archive with only these
+            locales and "none" to leave them as separate directories. Defaults to "append".
+            max_jobs (int, optional): Most locales compiled at once. Defaults to None.
+        """
 
         # Uncomment each specified locale in /etc/locale.gen
         with open(f"{self.target}/etc/locale.gen", "r") as locale_gen_file:
@@ -207,8 +395,37 @@ class Chroot:
         with open(f"{self.target}/etc/locale.gen", "w") as locale_gen_file:
             locale_gen_file.write(locale_file_data)
 
-        # Generate locales
-        self.__wrap_chroot("locale-gen")
+        # Compile each locale into its own directory, which unlike the
+        # archive can be written by several localedef processes at once
+        localedef_commands = []
+        for locale in locale_gen:
+            name, charmap = locale.split()
+
+            # localedef exits with 1 when there were only warnings
+            localedef_command = \
+                f"localedef --no-archive -i {get_locale_input(name)} -c -f {charmap}" \
+                + f" -A /usr/share/locale/locale.alias {name}; [ $? -le 1 ]"
+
+            localedef_commands.append(
+                f"chroot {self.target} sh -c {quote(localedef_command)}"
+            )
+
+        cmd.Executor(max_jobs, self.dry_run).run_all(localedef_commands)
+
+        if locale_archive != "none":
+            if locale_archive == "minimal":
+                cmd.execute(
+                    f"rm -f {self.target}{LOCALE_DIR}/locale-archive",
+                    dry_run=self.dry_run
+                )
+
+            locale_dirs = " ".join(
+                f"{LOCALE_DIR}/{get_locale_directory(locale.split()[0])}"
+                for locale in locale_gen
+            )
+
+            self.__wrap_chroot(f"localedef --add-to-archive --replace {locale_dirs}")
+            self.__wrap_chroot(f"rm -rf {locale_dirs}")
 
         # Set the LANG variable to desired locale
         with open(f"{self.target}/etc/locale.conf", "w") as locale_conf_file:
@@ -230,88 +447,94 @@ class Chroot:
 
     # --------------------------------------------------------------------------
 
-    def set_root_password(self, root_password: str):
-        root_password_proc = self.__wrap_chroot(
-            "passwd",
+    def set_passwords(self, passwords: dict):
+        """Set the password of every user with a single chpasswd call
+
+        Args:
+            passwords (dict): Passwords by username, including root
+        """
+        self.__wrap_chroot(
+            "chpasswd",
             PipeOpts.STDOUT | PipeOpts.STDERR | PipeOpts.STDIN,
-            wait_for_proc=False
+            input="\n".join(f"{user}:{password}" for user, password in passwords.items())
         )
-        
-        if not self.dry_run and isinstance(root_password_proc, subprocess.Popen):
-            root_password_proc.communicate(
-                f"{root_password}\n{root_password}".encode())
 
     # --------------------------------------------------------------------------
 
-    def configure_user(
-        self,
-        username: str,
-        shell   : str,
-        home    : str,
-        comment : str,
-        groups  : list,
-        sudo    : bool | str,
-        password: str
-    ):
-        
-        self.__wrap_chroot(
-            f"useradd -m{f' -d {home}' if home else ''} {username}"
-        )
-
-        if shell:
-            # Try to install shell if it does not exist
-            with open(f"{self.target}/etc/shells", "r") as shells_file:
+    def configure_users(self, users: dict):
+        """Create every user, and any groups they need, in a single batch
 
-                shell_installed = False
-                for shell_line in shells_file.readlines()[3:]:
-                    if shell_line.strip() == shell:
-                        shell_installed = True
-                        break
+        Args:
+            users (dict): User configs by username
+        """
 
-                if not shell_installed:
-                    self.__wrap_chroot(
-                        f"pacman --noconfirm -S {shell.split('/')[-1]}"
-                    )
+        # Create every missing group in one go
+        new_groups = []
+        for user_config in users.values():
+            for group in user_config["groups"]:
+                if group not in self.system_groups and group not in new_groups:
+                    new_groups.append(group)
+
+        if new_groups:
+            self.__wrap_chroot(self.__batch({
+                f"create group {group}" : f"groupadd {group}"
+                for group in new_groups
+            }))
+            self.system_groups += new_groups
+
+        # Each user is created with its home, shell, comment and groups set up front
+        useradd_commands = {}
+        for username, user_config in users.items():
+            useradd_command = "useradd -m"
+
+            if home := user_config["home"]:
+                useradd_command += f" -d {home}"
+
+            # The shell itself was installed along with the new root
+            if shell := user_config["shell"]:
+                useradd_command += f" -s {shell}"
+
+            # Add a comment if specified
+            if comment := user_config["comment"]:
+                useradd_command += f" -c {quote(comment)}"
+
+            if groups := user_config["groups"]:
+                useradd_command += f" -G {','.join(groups)}"
+
+            useradd_commands[f"create user {username}"] = f"{useradd_command} {username}"
+
+        # A user that fails to be created doesn't stop the others
+        if useradd_commands:
+            self.__wrap_chroot(self.__batch(useradd_commands))
+
+        for username, user_config in users.items():
+            if sudo := user_config["sudo"]:
+                if sudo == "nopass":
+                    sudo_user_conf = f"{username} ALL=(ALL:ALL) NOPASSWD: ALL"
+                else:
+                    sudo_user_conf = f"{username} ALL=(ALL:ALL) ALL"
                     
-            self.__wrap_chroot(f"usermod -s {shell} {username}")
-
-        # Add a comment if specified
-        if comment:
-            self.__wrap_chroot(f"usermod -c {comment} {username}")
-
-        if groups:
-            for group in groups:
-                # Create group if it does not exist
-                if group not in self.system_groups:
-                    self.__wrap_chroot(f"groupadd {group}")
-                    self.system_groups.append(group)
-                
-                # Add user to the group
-                self.__wrap_chroot(f"usermod -a -G {group}, {username}")
-
-        passwd_proc = self.__wrap_chroot(f"passwd {username}",
-                                         PipeOpts.STDOUT | PipeOpts.STDERR | PipeOpts.STDIN,
-                                         wait_for_proc=False)
-
-        if not self.dry_run and isinstance(passwd_proc, subprocess.Popen):
-            passwd_proc.communicate(f"{password}\n{password}".encode())
-            
-        if sudo:
-            if sudo == "nopass":
-                sudo_user_conf = f"{username} ALL=(ALL:ALL) NOPASSWD: ALL"
-            else:
-                sudo_user_conf = f"{username} ALL=(ALL:ALL) ALL"
-                
-            with open(f"{self.target}/etc/sudoers.d/{username}", "w") as sudoers:
-                sudoers.write(sudo_user_conf)
+                with open(f"{self.target}/etc/sudoers.d/{username}", "w") as sudoers:
+                    sudoers.write(sudo_user_conf)
 
     # --------------------------------------------------------------------------
 
     def configure_early_crypt(self, encrypted_block: Formattable):
         self.__add_hook("block", "encrypt")
 
+        crypt_options = [
+            self.profile["crypt-options"].get(option, option)
+            for option in encrypted_block.crypt_options
+        ]
+
+        parameter = "crypt-options-parameter" if crypt_options else "crypt-parameter"
+
         self.__add_kernel_parameter(
-            f"cryptdevice=UUID={encrypted_block.encrypt_uuid}:{encrypted_block.encrypt_label}"
+            self.profile[parameter].format(
+                uuid=encrypted_block.encrypt_uuid,
+                name=encrypted_block.encrypt_label,
+                options=",".join(crypt_options)
+            )
         )
 
     # --------------------------------------------------------------------------
@@ -322,12 +545,21 @@ class Chroot:
             + f"\tUUID={encrypted_block.encrypt_uuid}"
 
         if encrypted_block.uses_keyfile:
-            cmd.execute(
-                f"cp /tmp/{encrypted_block.encrypt_label}.key " \
-                + f"{self.target}/etc/cryptsetup-keys.d/"
-            )
-            crypttab_line += \
-                f"\t/etc/cryptsetup-keys.d/{encrypted_block.encrypt_label}.key\n"
+            keyfile = f"/etc/cryptsetup-keys.d/{encrypted_block.encrypt_label}.key"
+
+            if self.dry_run:
+                output.info(f"Installing keyfile {keyfile}", 1)
+            else:
+                install_keyfile(encrypted_block.keyfile_path, f"{self.target}{keyfile}")
+
+            crypttab_line += f"\t{keyfile}"
+        else:
+            crypttab_line += "\tnone"
+
+        if encrypted_block.crypt_options:
+            crypttab_line += f"\t{','.join(encrypted_block.crypt_options)}"
+
+        crypttab_line += "\n"
 
         with open(f"{self.target}/etc/crypttab", "a") as crypttab_file:
             crypttab_file.write(crypttab_line)
@@ -335,8 +567,6 @@ class Chroot:
     # --------------------------------------------------------------------------
 
     def configure_raid(self):
-        self.__wrap_chroot("pacman --noconfirm -S mdadm")
-
         # Scan for the current RAID arrays and their configurations and add them to the mdadm.conf file
         raid_conf = cmd.execute("mdadm --detail --scan",
                                 PipeOpts.STDOUT | PipeOpts.STDERR,
@@ -351,8 +581,66 @@ class Chroot:
 
     # --------------------------------------------------------------------------
 
-    def generate_initramfs(self):
-        self.__wrap_chroot("mkinitcpio -P")
+    def configure_initramfs(
+        self,
+        compression       : str,
+        compression_level : int | None = None,
+        modules_decompress: bool = True
+    ):
+        """Write a mkinitcpio drop-in with the compression settings, and spell
+        the hooks for the initramfs profile
+
+        Args:
+            compression (str): zstd, lz4 or none
+            compression_level (int, optional): Level passed to the compressor. Defaults to None.
+            modules_decompress (bool, optional): Store modules uncompressed in the image. Defaults to True.
+        """
+        initrd_conf = f'COMPRESSION="{COMPRESSORS[compression]}"\n'
+
+        if compression_level is not None and compression != "none":
+            initrd_conf += f"COMPRESSION_OPTIONS=(-{compression_level})\n"
+
+        # Compressing modules twice only slows down both the build and the boot
+        initrd_conf += f'MODULES_DECOMPRESS="{"yes" if modules_decompress else "no"}"\n'
+
+        # Hooks added so far may still be spelled for the other profile
+        self.__apply_hook_profile()
+
+        cmd.execute(f"mkdir -p {self.target}/etc/mkinitcpio.conf.d", dry_run=self.dry_run)
+
+        with open(f"{self.target}/etc/mkinitcpio.conf.d/excalibur.conf", "w") as initrd_conf_file:
+            initrd_conf_file.write(initrd_conf)
+
+    # --------------------------------------------------------------------------
+
+    def install_kernels(self):
+        """Do what the masked initcpio hook would have done short of building
+        any image, copy each kernel to /boot and write its preset
+        """
+        self.__wrap_chroot(
+            'for modules in /usr/lib/modules/*; do '
+                + '[ -f "$modules/pkgbase" ] || continue; '
+                + 'read -r pkgbase < "$modules/pkgbase"; '
+                + 'install -Dm644 "$modules/vmlinuz" "/boot/vmlinuz-$pkgbase"; '
+                + '[ -e "/etc/mkinitcpio.d/$pkgbase.preset" ] || '
+                + 'sed "s|%PKGBASE%|$pkgbase|g" /usr/share/mkinitcpio/hook.preset '
+                + '> "/etc/mkinitcpio.d/$pkgbase.preset"; '
+                + 'done'
+        )
+
+    # --------------------------------------------------------------------------
+
+    def generate_initramfs(self, kernel: str = "", all_presets: bool = True):
+        """Build the initramfs images, or UKIs, once everything they contain is final
+
+        Args:
+            kernel (str, optional): Only build the preset of this kernel. Defaults to "".
+            all_presets (bool, optional): Build every preset instead. Defaults to True.
+        """
+        if all_presets:
+            self.__wrap_chroot("mkinitcpio -P")
+        else:
+            self.__wrap_chroot(f"mkinitcpio -p linux{f'-{kernel}' if kernel else ''}")
 
     # --------------------------------------------------------------------------
 
@@ -367,8 +655,7 @@ class Chroot:
         with open(f"{self.target}/etc/sudoers.d/aurbuilder", "w") as sudoers:
             sudoers.write("aurbuilder ALL=(ALL:ALL) NOPASSWD: ALL")
         
-        # Download git and clone the AUR helper repo
-        self.__wrap_chroot("pacman --noconfirm -S git")
+        # Clone the AUR helper repo, git was installed along with the new root
         self.__wrap_chroot(f"git clone {helper_url} ~/{helper}", user="aurbuilder")
 
         # Build and install the helper
@@ -377,20 +664,46 @@ class Chroot:
 
     # --------------------------------------------------------------------------
 
-    def install_packages(self, packages: list):
+    def remove_aur_builder(self):
+        """Delete the temporary makepkg user along with its passwordless sudo
+        rule, nothing is installed through the AUR helper after this
+        """
+        self.__wrap_chroot("userdel -r aurbuilder")
+        self.__wrap_chroot("rm -f /etc/sudoers.d/aurbuilder")
+
+        self.installer = "pacman"
+
+    # --------------------------------------------------------------------------
+
+    def install_packages(self, packages: list, sync_ttl: int=0):
+        # Repo packages are all installed by pacstrap, so this is a single
+        # transaction which only resyncs the databases if they have gone stale
+        sync = "-S" if get_database_age(self.target) <= sync_ttl else "-Sy"
+
         if self.installer == "pacman":
-            self.__wrap_chroot(f"pacman --noconfirm -Syu {' '.join(packages)}")
+            self.__wrap_chroot(f"pacman --noconfirm {sync} {' '.join(packages)}")
         else:
             self.__wrap_chroot(
-                f"{self.installer.strip('-bin')} --noconfirm -Syu {' '.join(packages)}",
+                f"{self.installer.strip('-bin')} --noconfirm {sync} {' '.join(packages)}",
                 user="aurbuilder"
             )
 
     # --------------------------------------------------------------------------
 
+    def run_deferred_hooks(self):
+        """Run each deferred hook once, in the order pacman would have, and
+        stop deferring them since no more packages are installed after this
+        """
+        self.deferred_hooks.replay(
+            lambda command, input: self.__wrap_chroot(command, input=input)
+        )
+        self.deferred_hooks.restore()
+
+    # --------------------------------------------------------------------------
+
     def enable_services(self, services: list):
-        for service in services:
-            self.__wrap_chroot(f"systemctl enable {service}")
+        # A single systemctl call enables every unit
+        self.__wrap_chroot(f"systemctl enable {' '.join(services)}")
             
     # --------------------------------------------------------------------------
     
@@ -411,43 +724,57 @@ class Chroot:
         
     # --------------------------------------------------------------------------
         
-    def generate_ukis(self):
+    def configure_presets(self, fallback: bool = True, uki: bool = False):
+        """Edit the mkinitcpio presets before anything is built from them
+
+        Args:
+            fallback (bool, optional): Keep the fallback images. Defaults to True.
+            uki (bool, optional): Build unified kernel images rather than plain images. Defaults to False.
+        """
         presets_dir = f"{self.target}/etc/mkinitcpio.d/"
-        
-        cmd.execute(f"mkdir -p {self.efi_dir}/EFI/Linux", dry_run=self.dry_run)
-        
-        self.generate_initramfs()
-        
+
+        if uki:
+            cmd.execute(f"mkdir -p {self.efi_dir}/EFI/Linux", dry_run=self.dry_run)
+
         for preset in listdir(presets_dir):
             with open(presets_dir + preset, "r") as preset_file:
                 preset_config = preset_file.read()
-                
-            # Uncomment default and fallback UKI lines in preset and set the efi directory
-            preset_config = resub(
-                r'\n#(default_uki=")/efi',
-                rf'\n\g<1>{self.efi_dir}',
-                preset_config
-            )
-            
-            preset_config = resub(
-                r'\n#(fallback_uki=")/efi',
-                rf'\n\g<1>{self.efi_dir}',
-                preset_config
-            )
-            
-            # Comment out the initramfs default and fallback image lines
-            preset_config = resub(
-                r'\n(default_image)',
-                r'\n#\g<1>',
-                preset_config
-            )
-            
-            preset_config = resub(
-                r'\n(fallback_image)',
-                r'\n#\g<1>',
-                preset_config
-            )
-            
+
+            # Only build the default image unless the fallback is wanted
+            if not fallback:
+                preset_config = resub(
+                    r'\nPRESETS=\([^)]*\)',
+                    "\nPRESETS=('default')",
+                    preset_config
+                )
+
+            if uki:
+                # Uncomment default and fallback UKI lines in preset and set the efi directory
+                preset_config = resub(
+                    r'\n#(default_uki=")/efi',
+                    rf'\n\g<1>{self.efi_dir}',
+                    preset_config
+                )
+
+                preset_config = resub(
+                    r'\n#(fallback_uki=")/efi',
+                    rf'\n\g<1>{self.efi_dir}',
+                    preset_config
+                )
+
+                # Comment out the initramfs default and fallback image lines
+                preset_config = resub(
+                    r'\n(default_image)',
+                    r'\n#\g<1>',
+                    preset_config
+                )
+
+                preset_config = resub(
+                    r'\n(fallback_image)',
+                    r'\n#\g<1>',
+                    preset_config
+                )
+
             with open(presets_dir+preset, "w") as preset_file:
                 preset_file.write(preset_config)
 
@@ -507,27 +834,29 @@ class Chroot:
         
     # --------------------------------------------------------------------------
     
-    def generate_fstab(self):
-        genfstab = cmd.execute(f"genfstab -U {self.target}", 6, self.dry_run)
-        
-        if isinstance(genfstab, tuple):
-            mounts = genfstab[0].decode()
-        
-            with open(f"{self.target}/etc/fstab", "a") as fstab_file:
-                fstab_file.write(mounts)
+    def generate_fstab(self, fstab_entries: str):
+        if self.dry_run:
+            output.info(f"Generated fstab:\n{fstab_entries}", 1)
+            return
+
+        with open(f"{self.target}/etc/fstab", "a") as fstab_file:
+            fstab_file.write(fstab_entries)
             
     # --------------------------------------------------------------------------
 
     def exit(self):
         # Clean up aur helper user if needed
         if self.installer != "pacman":
-            self.__wrap_chroot("userdel aurbuilder")
-            self.__wrap_chroot("rm /etc/sudoers.d/aurbuilder")
-            
-        cmd.execute(
-            f"rm {self.target}/etc/pacman.d/hooks/90-mkinitcpio-install.hook",
-            dry_run=self.dry_run
-        )
+            self.remove_aur_builder()
+
+        # The shell keeps the new root busy, so it has to go before unmounting
+        if self.shell:
+            self.shell.close()
+
+        self.deferred_hooks.restore()
+
+        if self.package_cache:
+            self.package_cache.unbind(self.target)
 
         # Unmount all API filesystems from new root
         cmd.execute(f"umount -R {self.target}/proc/", dry_run=self.dry_run)
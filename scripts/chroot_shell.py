@@ -0,0 +1,161 @@
+import os
+import selectors
+
+from subprocess import Popen, PIPE
+from shlex      import quote
+from uuid       import uuid4
+
+import command_utils as cmd
+import output_utils  as output
+
+#------------------------------------------------------------------------------
+
+class ChrootShell:
+    """A long-lived shell running inside the new root
+
+    Commands are streamed into the shell's stdin one at a time instead of
+    spawning a new `chroot <target> sh -c` process for each of them. After
+    every command the shell prints a unique marker along with the exit status
+    to both stdout and stderr, which is used to split the output streams back
+    up per command.
+    """
+
+    READ_SIZE = 65536
+
+    #--------------------------------------------------------------------------
+
+    def __init__(self, target_mountpoint: str, dry_run: bool=False):
+        self.target  = target_mountpoint
+        self.dry_run = dry_run
+
+        self.process = None
+
+    #--------------------------------------------------------------------------
+
+    def start(self):
+        if self.dry_run or self.process:
+            return
+
+        self.process = Popen(
+            ["chroot", self.target, "sh"],
+            stdin =PIPE,
+            stdout=PIPE,
+            stderr=PIPE
+        )
+
+    #--------------------------------------------------------------------------
+
+    def __build_script(self, command: str, marker: str, input: str | None) -> bytes:
+        # Each command runs in a subshell so that a stray `cd`, `exit` or
+        # variable assignment cannot leak into the following commands
+        if input is None:
+            script = f"( {command}\n) </dev/null\n"
+        else:
+            if not input.endswith("\n"):
+                input += "\n"
+            script = f"( {command}\n) <<'{marker}'\n{input}{marker}\n"
+
+        script += f"printf '\\n%s %d\\n' '{marker}' $?\n"
+        script += f"printf '\\n%s\\n' '{marker}' >&2\n"
+
+        return script.encode()
+
+    #--------------------------------------------------------------------------
+
+    def __read_until_markers(self, marker: str) -> tuple[int, bytes, bytes]:
+        stdout_marker = f"\n{marker} ".encode()
+        stderr_marker = f"\n{marker}\n".encode()
+
+        buffers = {
+            self.process.stdout.fileno(): bytearray(),
+            self.process.stderr.fileno(): bytearray()
+        }
+
+        returncode = None
+        stdout_end = stderr_end = -1
+
+        with selectors.DefaultSelector() as selector:
+            for fd in buffers:
+                selector.register(fd, selectors.EVENT_READ)
+
+            while returncode is None or stderr_end < 0:
+                if not selector.get_map():
+                    raise cmd.CommandFailedException(
+                        "Chroot shell exited unexpectedly"
+                    )
+
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, ChrootShell.READ_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fd)
+                        continue
+                    buffers[key.fd] += chunk
+
+                stdout = buffers[self.process.stdout.fileno()]
+                stderr = buffers[self.process.stderr.fileno()]
+
+                if returncode is None and (stdout_end := stdout.find(stdout_marker)) >= 0:
+                    status_end = stdout.find(b"\n", stdout_end + len(stdout_marker))
+                    if status_end >= 0:
+                        returncode = int(
+                            stdout[stdout_end + len(stdout_marker):status_end]
+                        )
+
+                if stderr_end < 0:
+                    stderr_end = stderr.find(stderr_marker)
+
+        return returncode, bytes(stdout[:stdout_end]), bytes(stderr[:stderr_end])
+
+    #--------------------------------------------------------------------------
+
+    def run(
+        self,
+        command     : str,
+        user        : str  = "",
+        input       : str | None = None,
+        print_errors: bool = True,
+        \
+    ) -> tuple[int, bytes, bytes] | None:
+        """Run a command in the persistent chroot shell
+
+        Args:
+            command (str): Command to be executed
+            user (str, optional): Run the command as this user via su. Defaults to "".
+            input (str, optional): Text to feed to the command's stdin. Defaults to None.
+            print_errors (bool, optional): Report a non-zero exit status. Defaults to True.
+
+        Returns:
+            tuple[int, bytes, bytes]: The exit status, stdout and stderr of the command
+            None: If dry running
+        """
+        if user:
+            command = f"su {user} -c {quote(command)}"
+
+        if self.dry_run:
+            output.print_command(f"chroot {self.target} {command}")
+            return
+
+        self.start()
+
+        marker = f"__EXCALIBUR_{uuid4().hex}__"
+
+        self.process.stdin.write(self.__build_script(command, marker, input))
+        self.process.stdin.flush()
+
+        returncode, stdout, stderr = self.__read_until_markers(marker)
+
+        if print_errors and returncode != 0:
+            cmd.handle_failure(command, stderr)
+
+        return returncode, stdout, stderr
+
+    #--------------------------------------------------------------------------
+
+    def close(self):
+        if not self.process:
+            return
+
+        self.process.communicate(b"exit\n")
+        self.process = None
+
+# EOF
@@ -1,5 +1,10 @@
+import os
+import asyncio
+
 from subprocess  import Popen, PIPE
 from shlex       import split as shsplit
+from threading   import Lock
+from weakref     import WeakKeyDictionary
 from typing      import Union, TypedDict
 from dataclasses import dataclass, fields
 
@@ -25,6 +30,37 @@ class PipeOptsDict(TypedDict):
     stderr: Union[int, None]
     stdin:  Union[int, None]
 
+# Only one failed command at a time may ask the user whether to continue
+PROMPT_LOCK = Lock()
+
+#------------------------------------------------------------------------------
+
+def get_pipes(pipe_mode: int) -> PipeOptsDict:
+    """Translate a pipe mode into keyword arguments for a subprocess
+
+    Parameters
+    ----------
+    pipe_mode : int
+        Octal code to specify which streams should be pipes
+
+    Returns
+    -------
+    PipeOptsDict
+        The stdout, stderr and stdin arguments, set to PIPE where requested
+    """
+    std: PipeOptsDict = {
+            "stdout" : None,
+            "stderr" : None,
+            "stdin"  : None,
+        }
+
+    for pipe_opt, std_code in zip(fields(PipeOpts), std):
+        pipe_opt_value: int = getattr(PipeOpts, pipe_opt.name)
+        if pipe_opt_value & pipe_mode == pipe_opt_value:
+            std[std_code] = PIPE
+
+    return std
+
 #------------------------------------------------------------------------------
 
 def execute(
@@ -72,16 +108,7 @@ def execute(
         output.print_command(command)
         return
 
-    std: PipeOptsDict = {
-            "stdout" : None,
-            "stderr" : None,
-            "stdin"  : None,
-        }
-
-    for pipe_opt, std_code in zip(fields(PipeOpts), std):
-        pipe_opt_value: int = getattr(PipeOpts, pipe_opt.name)
-        if pipe_opt_value & pipe_mode == pipe_opt_value:
-            std[std_code] = PIPE
+    std = get_pipes(pipe_mode)
 
     process = Popen(
         shsplit(command),
@@ -97,8 +124,30 @@ def execute(
 
     # If there are any errors, print them
     if print_errors and std["stderr"] and process.poll() != 0:
+        handle_failure(command, proc_comm[1])
+
+    return proc_comm
+
+#------------------------------------------------------------------------------
+
+def handle_failure(command: str, error_output: bytes):
+    """Print the errors of a failed command and ask whether to continue
+
+    Parameters
+    ----------
+    command : str
+        The command that failed
+    error_output : bytes
+        Everything the command wrote to stderr
+
+    Raises
+    ------
+    CommandFailedException
+        Raised if the user chooses not to continue
+    """
+    with PROMPT_LOCK:
         output.error(f"Command '{command}' failed to execute")
-        print(proc_comm[1].decode())
+        print(error_output.decode())
 
         if (i := output.get_input(
             "Would you like to continue? (N/y)"
@@ -106,6 +155,141 @@ def execute(
             
             raise CommandFailedException(command)
 
+#------------------------------------------------------------------------------
+
+async def execute_async(
+    command      : str,
+    pipe_mode    : int   = PipeOpts.STDERR,
+    dry_run      : bool  = False,
+    print_errors : bool  = True,
+    input        : bytes = None,
+    \
+) -> tuple[bytes, bytes] | None:
+    """Execute a command without blocking the event loop
+
+    Parameters
+    ----------
+    command : str
+        Command to be executed
+    pipe_mode : int, optional
+        Octal code to specify which streams should be pipes, by default 2
+    dry_run : bool, optional
+        If true, only print the command instead of executing, by default False
+    print_errors : bool, optional
+        If true, print errors if the return code is not 0, by default True
+    input : bytes, optional
+        Data to send to the command's stdin, by default None
+
+    Returns
+    -------
+    tuple[bytes, bytes]
+        The result of process.communicate
+
+    Raises
+    ------
+    CommandFailedException
+        Raised if the specified command exits with a non-zero return code and the user chooses not to continue
+    """
+
+    if dry_run:
+        output.print_command(command)
+        return
+
+    if input is not None:
+        pipe_mode |= PipeOpts.STDIN
+
+    std = get_pipes(pipe_mode)
+
+    process = await asyncio.create_subprocess_exec(
+        *shsplit(command),
+        stdout=std["stdout"],
+        stderr=std["stderr"],
+        stdin =std["stdin"]
+    )
+
+    proc_comm = await process.communicate(input)
+
+    # If there are any errors, print them. The prompt blocks, so it waits in
+    # a worker thread to keep the other commands' pipes flowing
+    if print_errors and std["stderr"] and process.returncode != 0:
+        await asyncio.to_thread(handle_failure, command, proc_comm[1])
+
     return proc_comm
 
+#------------------------------------------------------------------------------
+
+class Executor:
+    """Run independent commands concurrently with a limit on how many run at once
+    """
+
+    def __init__(self, max_jobs: int | None = None, dry_run: bool = False):
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.dry_run  = dry_run
+
+        # A semaphore is bound to the event loop it is first used in, so
+        # every loop gets its own
+        self.__semaphores = WeakKeyDictionary()
+
+    #--------------------------------------------------------------------------
+
+    def __get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self.__semaphores:
+            self.__semaphores[loop] = asyncio.Semaphore(self.max_jobs)
+
+        return self.__semaphores[loop]
+
+    #--------------------------------------------------------------------------
+
+    async def execute(
+        self,
+        command      : str,
+        pipe_mode    : int   = PipeOpts.STDERR,
+        print_errors : bool  = True,
+        input        : bytes = None,
+        \
+    ) -> tuple[bytes, bytes] | None:
+        async with self.__get_semaphore():
+            return await execute_async(
+                command,
+                pipe_mode,
+                self.dry_run,
+                print_errors,
+                input
+            )
+
+    #--------------------------------------------------------------------------
+
+    async def __gather(self, commands: list[str], pipe_mode: int, print_errors: bool):
+        return await asyncio.gather(
+            *(self.execute(command, pipe_mode, print_errors) for command in commands)
+        )
+
+    #--------------------------------------------------------------------------
+
+    def run_all(
+        self,
+        commands     : list[str],
+        pipe_mode    : int  = PipeOpts.STDERR,
+        print_errors : bool = True,
+        \
+    ) -> list[tuple[bytes, bytes] | None]:
+        """Run every command, at most max_jobs at a time, and wait for all of them
+
+        Parameters
+        ----------
+        commands : list[str]
+            Commands to be executed
+        pipe_mode : int, optional
+            Octal code to specify which streams should be pipes, by default 2
+        print_errors : bool, optional
+            If true, print errors if a return code is not 0, by default True
+
+        Returns
+        -------
+        list[tuple[bytes, bytes] | None]
+            The results of each command in the same order as the commands were given
+        """
+        return asyncio.run(self.__gather(commands, pipe_mode, print_errors))
+
 # EOF
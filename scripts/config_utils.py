@@ -41,7 +41,11 @@ class Defaults(Enum):
         "networkmanager" : Choice(True, False),
         "ssh" : Choice(True, False),
         "reflector" : Choice(True, False),
-        "btrfs" : {}
+        "btrfs" : {},
+        "pacman" : {},
+        "initramfs" : {},
+        "luks" : {},
+        "resync" : {}
     }
 
     DRIVE = {
@@ -61,20 +65,43 @@ class Defaults(Enum):
     RAID = {
         "devices" : Required(),
         "array-name" : Required(),
-        "level" : Required()
+        "level" : Required(),
+        "chunk-size" : None,
+        "assume-clean" : Choice(False, True),
+        "bitmap" : Choice("", "internal", "none")
+    }
+
+    RESYNC = {
+        "speed-limit-min" : None,
+        "speed-limit-max" : None,
+        "wait" : Choice(False, True)
     }
 
     CRYPT = {
         "crypt-label" : Required(),
         "load-early" : Choice(False, True),
         "generate-keyfile" : Choice(False, True),
-        "password" : "password"
+        "password" : "password",
+        "no-read-workqueue" : Choice(False, True),
+        "no-write-workqueue" : Choice(False, True),
+        "allow-discards" : Choice(False, True),
+        "sector-size" : None,
+        "persistent" : Choice(True, False)
+    }
+
+    LUKS = {
+        "unlock-time" : 2000,
+        "pbkdf-memory" : 1048576,
+        "calibrate" : Choice(True, False),
+        "benchmark-cache" : "/var/cache/excalibur/pbkdf-benchmarks.json"
     }
 
     FILESYSTEM = {
         "filesystem": Choice(Required(), "efi", "swap", "ext4", "xfs", "btrfs"),
         "label": None,
-        "mountpoint": None
+        "mountpoint": None,
+        "mount-options": [],
+        "swap-priority": None
     }
 
     CLOCK = {
@@ -87,7 +114,8 @@ class Defaults(Enum):
         "locale-gen" : [
             "en_US.UTF-8 UTF-8"
         ],
-        "locale-conf" : "en_US.UTF-8"
+        "locale-conf" : "en_US.UTF-8",
+        "locale-archive" : Choice("append", "minimal", "none")
     }
 
     USER = {
@@ -114,6 +142,30 @@ class Defaults(Enum):
         "options" : ""
     }
     
+    PACMAN = {
+        "cache-directory" : "",
+        "cache-max-size" : "0",
+        "cache-max-age" : 0,
+        "prefetch" : Choice(True, False),
+        "sync-ttl" : 3600,
+        "deferred-hooks" : [
+            "man-db.hook",
+            "fontconfig.hook",
+            "update-desktop-database.hook",
+            "gtk-update-icon-cache.hook",
+            "71-dkms-install.hook"
+        ]
+    }
+    
+    INITRAMFS = {
+        "profile" : Choice("busybox", "systemd"),
+        "all-presets" : Choice(True, False),
+        "fallback" : Choice(True, False),
+        "compression" : Choice("zstd", "lz4", "none"),
+        "compression-level" : None,
+        "modules-decompress" : Choice(True, False)
+    }
+
     BTRFS_SUBVOL = {
         "mountpoint" : "",
         "compression" : "",
@@ -166,6 +218,12 @@ class Config:
                 ["raid", array]
             )
 
+        self.resync = self.fill_defaults(
+            config["resync"],
+            Defaults.RESYNC,
+            ["resync"]
+        )
+
         self.crypt = {}
         for crypt_dev in config["crypt"]:
             crypt_config = config["crypt"][crypt_dev]
@@ -179,6 +237,12 @@ class Config:
                 ["crypt", crypt_dev]
             )
 
+        self.luks = self.fill_defaults(
+            config["luks"],
+            Defaults.LUKS,
+            ["luks"]
+        )
+
         self.filesystems = {}
         for device in config["filesystems"]:
             filesystem_config = config["filesystems"][device]
@@ -232,6 +296,18 @@ class Config:
         self.ssh            = config["ssh"]
         self.reflector      = config["reflector"]
 
+        self.pacman = self.fill_defaults(
+            config["pacman"],
+            Defaults.PACMAN,
+            ["pacman"]
+        )
+
+        self.initramfs = self.fill_defaults(
+            config["initramfs"],
+            Defaults.INITRAMFS,
+            ["initramfs"]
+        )
+
         self.btrfs = {}
         for btrfs_dev in config["btrfs"]:
             btrfs_config = config["btrfs"][btrfs_dev]
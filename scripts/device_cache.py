@@ -0,0 +1,113 @@
+from os.path   import realpath
+from threading import Lock
+
+import command_utils as cmd
+
+from command_utils import PipeOpts
+
+#------------------------------------------------------------------------------
+
+class DeviceCache:
+    """Block device metadata filled by a single blkid scan of every device
+
+    Lookups are answered from the last scan, indexed by device path, UUID and
+    PARTUUID. Anything that changes the metadata of a device (sgdisk, mkfs,
+    luksFormat, mdadm, ...) must call invalidate() so the next lookup rescans.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+
+        self.__by_path     = {}
+        self.__by_uuid     = {}
+        self.__by_partuuid = {}
+
+        self.__valid = False
+
+    #--------------------------------------------------------------------------
+
+    def __scan(self):
+        # Bypass blkid's own cache file so that every device is actually probed
+        blkid = cmd.execute(
+            "blkid -c /dev/null -o export",
+            PipeOpts.STDOUT | PipeOpts.STDERR,
+            print_errors=False
+        )
+
+        self.__by_path.clear()
+        self.__by_uuid.clear()
+        self.__by_partuuid.clear()
+
+        for block in blkid[0].decode().strip().split("\n\n"):
+            tags = dict(
+                line.split("=", 1) for line in block.splitlines() if "=" in line
+            )
+
+            if "DEVNAME" not in tags:
+                continue
+
+            # Index both the name blkid reports and what it resolves to so
+            # that symlinks like /dev/md/<name> can be looked up directly
+            self.__by_path[tags["DEVNAME"]] = tags
+            self.__by_path[realpath(tags["DEVNAME"])] = tags
+
+            if "UUID" in tags:
+                self.__by_uuid[tags["UUID"]] = tags
+            if "PARTUUID" in tags:
+                self.__by_partuuid[tags["PARTUUID"]] = tags
+
+        self.__valid = True
+
+    #--------------------------------------------------------------------------
+
+    def __lookup(self, index: dict, key: str) -> dict:
+        with self.__lock:
+            if not self.__valid:
+                self.__scan()
+
+            return index.get(key, {})
+
+    #--------------------------------------------------------------------------
+
+    def invalidate(self):
+        with self.__lock:
+            self.__valid = False
+
+    #--------------------------------------------------------------------------
+
+    def get(self, device_path: str, tag: str, dry_run: bool=False) -> str | None:
+        """Get a tag (UUID, PARTUUID, TYPE, ...) of a block device
+
+        Args:
+            device_path (str): Path to the block device
+            tag (str): The blkid tag to get
+            dry_run (bool, optional): Return a placeholder without scanning. Defaults to False.
+
+        Returns:
+            str: The value of the tag
+            None: If the device or tag was not found
+        """
+        if dry_run:
+            return f"<{tag}:{device_path}>"
+
+        tags = self.__lookup(self.__by_path, device_path) \
+            or self.__lookup(self.__by_path, realpath(device_path))
+
+        return tags.get(tag)
+
+    #--------------------------------------------------------------------------
+
+    def find_by_uuid(self, uuid: str) -> str | None:
+        return self.__lookup(self.__by_uuid, uuid).get("DEVNAME")
+
+    #--------------------------------------------------------------------------
+
+    def find_by_partuuid(self, partuuid: str) -> str | None:
+        return self.__lookup(self.__by_partuuid, partuuid).get("DEVNAME")
+
+#------------------------------------------------------------------------------
+
+# Shared by everything that needs to look up block device metadata
+blkid_cache = DeviceCache()
+
+# EOF
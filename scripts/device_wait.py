@@ -0,0 +1,151 @@
+import os
+import ctypes
+import ctypes.util
+
+from os.path import exists, dirname
+from select  import select
+from time    import monotonic
+
+import command_utils as cmd
+import output_utils  as output
+
+#------------------------------------------------------------------------------
+
+# How long to wait for udev to create device nodes before giving up
+DEFAULT_TIMEOUT = 30
+
+# inotify(7) constants
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC  = os.O_CLOEXEC
+IN_ATTRIB   = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE   = 0x00000100
+
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+
+#------------------------------------------------------------------------------
+
+class DeviceTimeoutException(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+#------------------------------------------------------------------------------
+
+class Inotify:
+    """Minimal ctypes wrapper around the inotify syscalls
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watched = set()
+
+    #--------------------------------------------------------------------------
+
+    def watch(self, directory: str):
+        if directory in self.watched:
+            return
+
+        if self.libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {directory}")
+
+        self.watched.add(directory)
+
+    #--------------------------------------------------------------------------
+
+    def wait(self, timeout: float) -> bool:
+        """Block until an event arrives or the timeout runs out
+
+        Returns:
+            bool: True if any events were read
+        """
+        readable, _, _ = select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return False
+
+        # The events themselves don't matter, everything is rechecked anyway
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        return True
+
+    #--------------------------------------------------------------------------
+
+    def close(self):
+        os.close(self.fd)
+
+#------------------------------------------------------------------------------
+
+def nearest_existing_directory(path: str) -> str:
+    directory = dirname(path)
+    while not exists(directory):
+        directory = dirname(directory)
+
+    return directory
+
+#------------------------------------------------------------------------------
+
+def wait_for_devices(
+    paths  : list[str],
+    timeout: float = DEFAULT_TIMEOUT,
+    dry_run: bool  = False
+):
+    """Wait until every path (device node or /dev/disk symlink) exists
+
+    Rather than sleeping, the closest existing parent directory of each
+    missing path is watched with inotify, so this returns as soon as udev
+    has created the last of them.
+
+    Args:
+        paths (list[str]): Device paths that are expected to appear
+        timeout (float, optional): Seconds to wait before giving up. Defaults to DEFAULT_TIMEOUT.
+        dry_run (bool, optional): Don't wait at all. Defaults to False.
+
+    Raises:
+        DeviceTimeoutException: Raised if some of the paths did not appear in time
+    """
+    if dry_run:
+        return
+
+    try:
+        inotify = Inotify()
+    except OSError:
+        # Fall back on waiting for the whole udev queue to be processed
+        cmd.execute(f"udevadm settle --timeout={int(timeout)}")
+        inotify = None
+
+    deadline = monotonic() + timeout
+
+    try:
+        while True:
+            missing = [path for path in paths if not exists(path)]
+            if not missing:
+                return
+
+            remaining = deadline - monotonic()
+            if not inotify or remaining <= 0:
+                break
+
+            # Watches are added before the next check so that nothing created
+            # in between can be missed
+            for path in missing:
+                inotify.watch(nearest_existing_directory(path))
+
+            if all(not exists(path) for path in missing):
+                inotify.wait(remaining)
+    finally:
+        if inotify:
+            inotify.close()
+
+    output.error(f"Timed out waiting for {', '.join(missing)}")
+    raise DeviceTimeoutException(*missing)
+
+# EOF
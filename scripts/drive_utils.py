@@ -1,8 +1,66 @@
-from re import search
+from re          import search
+from os          import path
+from dataclasses import dataclass
 
 import command_utils as cmd
 import output_utils  as output
 
+from device_cache  import blkid_cache
+from device_wait   import wait_for_devices
+from fstab         import get_mount_options
+from luks          import generate_keyfile
+from size_utils    import parse_size
+
+#------------------------------------------------------------------------------
+
+# mdadm's chunk size in KiB when none is given
+DEFAULT_CHUNK_SIZE = 512
+
+# ext4 and xfs are aligned assuming 4KiB blocks
+FILESYSTEM_BLOCK_SIZE = 4
+
+#------------------------------------------------------------------------------
+
+@dataclass
+class StripeGeometry:
+    chunk_size: int
+    data_disks: int
+
+    @property
+    def stripe_width(self) -> int:
+        return self.chunk_size * self.data_disks
+
+#------------------------------------------------------------------------------
+
+def normalize_raid_level(level: str | int) -> str:
+    """Get the bare RAID level, mdadm accepts both 5 and raid5
+    """
+    return str(level).lower().removeprefix("raid")
+
+#------------------------------------------------------------------------------
+
+def get_data_disks(level: str | int, members: int) -> int | None:
+    """Get how many members of an array hold distinct data in each stripe
+
+    Args:
+        level (str | int): RAID level, with or without the raid prefix
+        members (int): Number of devices in the array
+
+    Returns:
+        int | None: The number of data disks, or None if the level doesn't stripe
+    """
+    match normalize_raid_level(level):
+        case "0":
+            return members
+        case "5":
+            return members - 1
+        case "6":
+            return members - 2
+        case "10":
+            return members // 2
+
+    return None
+
 #------------------------------------------------------------------------------
 
 class Formattable:
@@ -13,36 +71,51 @@ class Formattable:
 
     def __init__(self, device_path    : str,
                        partition_label: str,
-                       dry_run        : bool=False):
+                       dry_run        : bool=False,
+                       probe          : bool=True):
 
         self.partition_path  = device_path
         self.partition_label = partition_label
-        self.partition_uuid  = self.__get_blkid("PARTUUID")
+        self.dry_run = dry_run
+
+        # The physical drives that back this device
+        self.spindles = {device_path}
+
+        self.partition_uuid  = self.__get_blkid("PARTUUID") if probe else None
 
         self.filesystem = None
         self.label      = None
         self.mountpoint = None
         self.uuid       = None
 
+        self.mount_options = []
+
+        # Set when the device is a striped RAID array, or is encrypted on top of one
+        self.stripe = None
+
         self.uses_keyfile  = False
+        self.keyfile_path  = None
         self.mapper_path   = None
         self.encrypt_uuid  = None
         self.encrypt_label = None
 
-        self.dry_run = dry_run
+        # dm-crypt options in crypttab spelling, so they can follow the
+        # device onto the installed system
+        self.crypt_options = []
 
     #--------------------------------------------------------------------------
 
     def __get_blkid(self, element: str):
-        return cmd.execute(
-            f"blkid -s {element} -o value {self.partition_path}", 4)[0].decode().strip()
+        return blkid_cache.get(self.partition_path, element, self.dry_run)
 
     #--------------------------------------------------------------------------
 
     def new_filesystem(self, filesystem: str,
                              label     : str="",
                              mountpoint: str="",
-                             options   : str="",):
+                             options   : str="",
+                             mount_options: list=None,
+                             swap_priority: int=None):
 
         if filesystem not in Formattable.FILESYSTEMS:
             output.warn(f"{filesystem} is not a valid filesystem")
@@ -66,10 +139,19 @@ class Formattable:
         if options:
             mkfs_command += f" {options}"
 
+        # Line the filesystem up with the RAID stripes unless told otherwise
+        if self.stripe:
+            if filesystem == "ext4" and "-E" not in options:
+                stride = self.stripe.chunk_size // FILESYSTEM_BLOCK_SIZE
+                mkfs_command += f" -E stride={stride},stripe_width={stride * self.stripe.data_disks}"
+            elif filesystem == "xfs" and "su=" not in options and "sunit=" not in options:
+                mkfs_command += f" -d su={self.stripe.chunk_size}k,sw={self.stripe.data_disks}"
+
         # Specify the block device to format
         mkfs_command += f" {self.partition_path}"
 
         cmd.execute(mkfs_command, dry_run=self.dry_run)
+        blkid_cache.invalidate()
 
         # Store filesystem information
         self.filesystem = filesystem
@@ -77,6 +159,10 @@ class Formattable:
         self.mountpoint = mountpoint
         self.uuid       = self.__get_blkid("UUID")
 
+        self.mount_options = get_mount_options(filesystem, mount_options)
+        if filesystem == "swap" and swap_priority is not None:
+            self.mount_options.append(f"pri={swap_priority}")
+
     #--------------------------------------------------------------------------
 
     def encrypt_partition(self, password   : str,
@@ -89,30 +175,66 @@ class Formattable:
         if "open-options" not in options:
             options["open-options"] = ""
 
+        # What cryptsetup reads from stdin, either the password or the key
+        secret = password.encode()
+
         if keyfile:
-            # Create the keyfile in /tmp
-            cmd.execute(f"dd bs=512 count=4 if=/dev/random of=/tmp/{mapper_name}.key iflag=fullblock")
+            # The key is staged on tmpfs and given to cryptsetup over stdin
+            if not self.dry_run:
+                self.keyfile_path, secret = generate_keyfile(mapper_name)
+
+            cryptsetup_format_command = "cryptsetup --key-file - -q"
+            cryptsetup_open_command   = "cryptsetup --key-file -"
 
-            cryptsetup_format_command = f"cryptsetup --key-file /tmp/{mapper_name}.key -q"
-            cryptsetup_open_command   = f"cryptsetup --key-file /tmp/{mapper_name}.key"
-            
             self.uses_keyfile = True
         else:
             cryptsetup_format_command = "cryptsetup -q"
             cryptsetup_open_command   = "cryptsetup"
 
+        if options.get("sector-size"):
+            options["format-options"] += f" --sector-size {options['sector-size']}"
+
+        # Start the encrypted data on a stripe boundary, in 512 byte sectors
+        if self.stripe:
+            options["format-options"] += f" --align-payload {self.stripe.stripe_width * 2}"
+
+        # Bypassing the kcryptd workqueues and passing discards through both
+        # speed up fast drives considerably
+        open_flags = {
+            "no-read-workqueue"  : ("--perf-no_read_workqueue", "no-read-workqueue"),
+            "no-write-workqueue" : ("--perf-no_write_workqueue", "no-write-workqueue"),
+            "allow-discards"     : ("--allow-discards", "discard")
+        }
+
+        for option, (flag, crypttab_option) in open_flags.items():
+            if options.get(option):
+                options["open-options"] += f" {flag}"
+                self.crypt_options.append(crypttab_option)
+
+        # LUKS2 can store the flags in its header so every later activation uses them
+        if self.crypt_options and options.get("persistent"):
+            options["open-options"] += " --persistent"
+
         cryptsetup_format_command += f" {options['format-options']} luksFormat {self.partition_path}"
         cryptsetup_open_command   += f" {options['open-options']} luksOpen {self.partition_path} {mapper_name}"
 
         luksformat_proc = cmd.execute(cryptsetup_format_command, 7, self.dry_run, False)
         if not self.dry_run:
-            luksformat_proc.communicate(password.encode())
+            luksformat_proc.communicate(secret)
+        blkid_cache.invalidate()
 
         luksopen_proc = cmd.execute(cryptsetup_open_command, 7, self.dry_run, False)
         if not self.dry_run:
-            luksopen_proc.communicate(password.encode())
+            luksopen_proc.communicate(secret)
 
         self.encrypt_uuid    = self.__get_blkid("UUID")
+
+        # Make sure udev has caught up with both the container and the mapping
+        wait_for_devices(
+            [f"/dev/mapper/{mapper_name}", f"/dev/disk/by-uuid/{self.encrypt_uuid}"],
+            dry_run=self.dry_run
+        )
+
         self.real_path       = self.partition_path
         self.partition_path  = f"/dev/mapper/{mapper_name}"
         self.encrypt_label   = mapper_name
@@ -124,7 +246,11 @@ class Formattable:
             case None:
                 return
             case "swap":
-                cmd.execute(f"swapon {self.partition_path}", dry_run=self.dry_run)
+                swapon_command = "swapon"
+                if swap_options := [opt for opt in self.mount_options if opt != "defaults"]:
+                    swapon_command += f" -o {','.join(swap_options)}"
+
+                cmd.execute(f"{swapon_command} {self.partition_path}", dry_run=self.dry_run)
             case _:
                 match self.mountpoint:
                     case None:
@@ -133,12 +259,28 @@ class Formattable:
                         return
                     case _:
                         cmd.execute(
-                            f"mount -m {self.partition_path} {override_mount}{self.mountpoint}",
+                            f"mount -m -o {','.join(self.mount_options)} " \
+                                + f"{self.partition_path} {override_mount}{self.mountpoint}",
                             dry_run=self.dry_run
                         )
 
     #--------------------------------------------------------------------------
 
+    def unmount_filesystem(self, override_mount=""):
+        match self.filesystem:
+            case None | "btrfs_":
+                return
+            case "swap":
+                cmd.execute(f"swapoff {self.partition_path}", dry_run=self.dry_run)
+            case _:
+                if self.mountpoint:
+                    cmd.execute(
+                        f"umount {override_mount}{self.mountpoint}",
+                        dry_run=self.dry_run
+                    )
+
+    #--------------------------------------------------------------------------
+
     def set_as_btrfs_device(self, label: str):
         self.filesystem = "btrfs_"
         self.label = label
@@ -160,10 +302,28 @@ class RaidArray(Formattable):
                        array_name: str,
                        level     : int=0,
                        options   : str="",
-                       dry_run   : bool=False):
+                       dry_run   : bool=False,
+                       assume_clean: bool=False,
+                       bitmap    : str="",
+                       chunk_size: str | int | None=None):
+
+        raid_level = normalize_raid_level(level)
 
         mdadm_command = f"mdadm --create --metadata=1.2"
 
+        if chunk_size:
+            mdadm_command += f" --chunk={chunk_size}"
+
+        # Skip the initial resync, the array contents are overwritten anyway
+        if assume_clean:
+            if raid_level in ("5", "6"):
+                output.warn(f"Parity of array {array_name} stays unverified until it is checked")
+            mdadm_command += " --assume-clean"
+
+        # An internal bitmap keeps resyncs after an unclean shutdown short
+        if bitmap:
+            mdadm_command += f" --bitmap={bitmap}"
+
         # Set the RAID level
         mdadm_command += f" --level={level}"
 
@@ -190,6 +350,9 @@ class RaidArray(Formattable):
                 mdadm_command += f" {device.partition_path}"
 
         cmd.execute(mdadm_command, dry_run=dry_run)
+        blkid_cache.invalidate()
+
+        wait_for_devices([f"/dev/md/{array_name}"], dry_run=dry_run)
 
         super().__init__(
             device_path=f"/dev/md/{array_name}",
@@ -197,6 +360,37 @@ class RaidArray(Formattable):
             dry_run=dry_run
         )
 
+        self.spindles = set()
+        for device in devices:
+            self.spindles |= device.spindles if hasattr(device, "spindles") else {device.device_path}
+
+        self.level   = level
+        self.members = len(devices)
+
+        if (data_disks := get_data_disks(raid_level, self.members)):
+            self.stripe = StripeGeometry(self.__get_chunk_size(chunk_size), data_disks)
+
+    #--------------------------------------------------------------------------
+
+    def __get_chunk_size(self, chunk_size: str | int | None) -> int:
+        """Get the chunk size the array was actually created with
+
+        Returns:
+            int: The chunk size in KiB
+        """
+        if self.dry_run:
+            if not chunk_size:
+                return DEFAULT_CHUNK_SIZE
+
+            # mdadm reads plain numbers as KiB
+            chunk_size = str(chunk_size)
+            return int(chunk_size) if chunk_size.isdigit() else parse_size(chunk_size) // 1024
+
+        md_device = path.basename(path.realpath(self.partition_path))
+
+        with open(f"/sys/block/{md_device}/md/chunk_size", "r") as chunk_size_file:
+            return int(chunk_size_file.read()) // 1024
+
 #------------------------------------------------------------------------------
 
 class Partition(Formattable):
@@ -217,20 +411,19 @@ class Partition(Formattable):
             start_sector = "0"
             end_sector   = f"+{partition_size}"
 
-        sgdisk_command = f"sgdisk -n {partition_number}:{start_sector}:{end_sector}"
+        # The partition is only described here, the drive writes all of its
+        # partitions to the table at once
+        self.sgdisk_options = f"-n {partition_number}:{start_sector}:{end_sector}"
 
         # Partition type code command portion
         if type_code:
-            sgdisk_command += f" -t {partition_number}:{type_code}"
+            self.sgdisk_options += f" -t {partition_number}:{type_code}"
 
         # Partition label command portion
         if partition_label:
-            sgdisk_command += f" -c {partition_number}:'{partition_label}'"
+            self.sgdisk_options += f" -c {partition_number}:'{partition_label}'"
 
-        # Specify the drive via its device path
-        sgdisk_command += f" {device_path}"
-
-        cmd.execute(sgdisk_command, dry_run=dry_run)
+        self.partition_number = partition_number
 
         partition_path = "{path}{sep}{num}".format(
             path=device_path,
@@ -238,7 +431,9 @@ class Partition(Formattable):
             num =partition_number
         )
 
-        super().__init__(partition_path, partition_label, dry_run=dry_run)
+        super().__init__(partition_path, partition_label, dry_run=dry_run, probe=False)
+
+        self.spindles = {device_path}
 
 #------------------------------------------------------------------------------
 
@@ -277,6 +472,53 @@ class Drive(Formattable):
 
     #--------------------------------------------------------------------------
 
+    def write_partition_table(self, dry_run: bool=False):
+        """Write every pending partition to the drive in a single sgdisk call,
+        then rescan the drive once and probe all of the new partitions at once
+
+        Args:
+            dry_run (bool, optional): Print, don't run commands. Defaults to False.
+        """
+        if not self.partitions:
+            return
+
+        sgdisk_command = "sgdisk"
+        for partition in self.partitions.values():
+            sgdisk_command += f" {partition.sgdisk_options}"
+
+        # Specify the drive via its device path
+        sgdisk_command += f" {self.device_path}"
+
+        cmd.execute(sgdisk_command, dry_run=dry_run)
+
+        # Have the kernel re-read the table once and wait for the new nodes
+        cmd.execute(f"partprobe {self.device_path}", dry_run=dry_run)
+        wait_for_devices(
+            [partition.partition_path for partition in self.partitions.values()],
+            dry_run=dry_run
+        )
+
+        # The next lookup rescans every device once, including the new partitions
+        blkid_cache.invalidate()
+
+        for partition in self.partitions.values():
+            partition.partition_uuid = blkid_cache.get(
+                partition.partition_path,
+                "PARTUUID",
+                dry_run
+            )
+
+        # Partitions blkid found no PARTUUID for never get a by-partuuid
+        # link, so only wait for their device node
+        wait_for_devices(
+            [f"/dev/disk/by-partuuid/{partition.partition_uuid}"
+             if partition.partition_uuid else partition.partition_path
+             for partition in self.partitions.values()],
+            dry_run=dry_run
+        )
+
+    #--------------------------------------------------------------------------
+
     def __getitem__(self, uid: str):
         return self.partitions[uid]
 
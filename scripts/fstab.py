@@ -0,0 +1,89 @@
+from mount_tree import MountTree
+
+#------------------------------------------------------------------------------
+
+# Mount options used when none are given in the config
+DEFAULT_MOUNT_OPTIONS = {
+    "efi"   : ["noatime", "fmask=0077", "dmask=0077"],
+    "vfat"  : ["noatime", "fmask=0077", "dmask=0077"],
+    "ext4"  : ["noatime"],
+    "xfs"   : ["noatime"],
+    "btrfs" : ["noatime"],
+    "swap"  : ["defaults"]
+}
+
+# Filesystem names as the kernel knows them
+FSTAB_TYPES = {
+    "efi" : "vfat"
+}
+
+#------------------------------------------------------------------------------
+
+def get_mount_options(filesystem: str, options: list | None = None) -> list:
+    """Get the mount options for a filesystem, falling back on tuned defaults
+
+    Args:
+        filesystem (str): The filesystem type as given in the config
+        options (list, optional): Options from the config. Defaults to None.
+
+    Returns:
+        list: The mount options to use
+    """
+    if options:
+        return list(options)
+
+    return list(DEFAULT_MOUNT_OPTIONS.get(filesystem, ["defaults"]))
+
+#------------------------------------------------------------------------------
+
+def fsck_order(filesystem: str, mountpoint: str) -> int:
+    # xfs and btrfs don't use fsck at boot
+    if filesystem in ("xfs", "btrfs", "swap"):
+        return 0
+
+    return 1 if mountpoint == "/" else 2
+
+#------------------------------------------------------------------------------
+
+def entry(uuid: str, mountpoint: str, filesystem: str, options: list) -> str:
+    return "\t".join([
+        f"UUID={uuid}",
+        mountpoint,
+        FSTAB_TYPES.get(filesystem, filesystem),
+        ",".join(options),
+        "0",
+        str(fsck_order(filesystem, mountpoint))
+    ])
+
+#------------------------------------------------------------------------------
+
+def generate(mount_tree: MountTree, swap_devices: list) -> str:
+    """Generate fstab entries straight from the in-memory device model
+
+    Args:
+        mount_tree (MountTree): Tree of every filesystem and subvolume to mount
+        swap_devices (list): Formattable devices formatted as swap
+
+    Returns:
+        str: The fstab entries, with parents ahead of their children
+    """
+    lines = []
+
+    for node in mount_tree.walk():
+        if isinstance(node.source, tuple):
+            btrfs, subvolume = node.source
+            lines.append(
+                entry(btrfs.uuid, node.mountpoint, "btrfs", btrfs.get_mount_options(subvolume))
+            )
+        else:
+            device = node.source
+            lines.append(
+                entry(device.uuid, node.mountpoint, device.filesystem, device.mount_options)
+            )
+
+    for device in swap_devices:
+        lines.append(entry(device.uuid, "none", "swap", device.mount_options))
+
+    return "\n".join(lines) + "\n"
+
+# EOF
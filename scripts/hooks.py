@@ -0,0 +1,187 @@
+from os       import path, remove
+from fnmatch  import fnmatch
+from typing   import Callable
+
+import command_utils as cmd
+import output_utils  as output
+
+#------------------------------------------------------------------------------
+
+SYSTEM_HOOK_DIR   = "/usr/share/libalpm/hooks"
+OVERRIDE_HOOK_DIR = "/etc/pacman.d/hooks"
+
+# This hook copies the kernel to /boot, writes its mkinitcpio preset and then
+# builds every image of that preset. It stays masked for the whole install and
+# is never replayed, the chroot installs the kernels itself and builds the
+# images once their configuration is final, see Chroot.install_kernels
+INITRAMFS_HOOK = "90-mkinitcpio-install.hook"
+
+#------------------------------------------------------------------------------
+
+def parse_hook(hook_path: str) -> dict:
+    """Parse an alpm hook file
+
+    configparser can't be used since keys like Target may repeat
+
+    Args:
+        hook_path (str): Path to the .hook file
+
+    Returns:
+        dict: Lists of triggers and the action of the hook
+    """
+    hook = {"triggers": [], "action": {}}
+    section = None
+
+    with open(hook_path, "r") as hook_file:
+        for line in hook_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            if line == "[Trigger]":
+                section = {"Type": "", "Target": []}
+                hook["triggers"].append(section)
+            elif line == "[Action]":
+                section = hook["action"]
+            elif section is not None:
+                key, _, value = line.partition("=")
+                key, value = key.strip(), value.strip()
+
+                if key == "Target":
+                    section["Target"].append(value)
+                else:
+                    section[key] = value or True
+
+    return hook
+
+#------------------------------------------------------------------------------
+
+def match_targets(patterns: list, candidates: list) -> list:
+    """Match alpm style target patterns, including negated ones, against candidates
+    """
+    matches = []
+    for candidate in candidates:
+        matched = False
+        for pattern in patterns:
+            if pattern.startswith("!"):
+                if fnmatch(candidate, pattern[1:]):
+                    matched = False
+            elif fnmatch(candidate, pattern):
+                matched = True
+
+        if matched:
+            matches.append(candidate)
+
+    return matches
+
+#------------------------------------------------------------------------------
+
+class HookDeferral:
+    """Mask expensive pacman hooks for the duration of the install
+
+    A masked hook is overridden by an empty file of the same name in
+    /etc/pacman.d/hooks, so pacman skips it in every transaction. Once
+    everything is installed each masked hook is run exactly once, in the
+    same order pacman would have run it, and the overrides are removed.
+    The initramfs hook is always masked as well, but never replayed.
+    """
+
+    def __init__(self, target_mountpoint: str, hooks: list, dry_run: bool=False):
+        self.target  = target_mountpoint
+        self.hooks   = [hook for hook in dict.fromkeys(hooks) if hook != INITRAMFS_HOOK]
+        self.masked  = self.hooks + [INITRAMFS_HOOK]
+        self.dry_run = dry_run
+
+    #--------------------------------------------------------------------------
+
+    @property
+    def override_dir(self) -> str:
+        return f"{self.target}{OVERRIDE_HOOK_DIR}"
+
+    #--------------------------------------------------------------------------
+
+    @property
+    def masks(self) -> list:
+        """Paths of the hook overrides inside the new root
+        """
+        return [f"{OVERRIDE_HOOK_DIR}/{hook}" for hook in self.masked]
+
+    #--------------------------------------------------------------------------
+
+    def mask(self):
+        cmd.execute(f"mkdir -p {self.override_dir}", dry_run=self.dry_run)
+
+        for hook in self.masked:
+            override = f"{self.override_dir}/{hook}"
+
+            # Never replace a hook override the user already has
+            if path.isfile(override) and path.getsize(override) > 0:
+                continue
+
+            cmd.execute(f"touch {override}", dry_run=self.dry_run)
+
+    #--------------------------------------------------------------------------
+
+    def restore(self):
+        for hook in self.masked:
+            override = f"{self.override_dir}/{hook}"
+
+            if self.dry_run:
+                output.print_command(f"rm {override}")
+            elif path.isfile(override) and path.getsize(override) == 0:
+                remove(override)
+
+    #--------------------------------------------------------------------------
+
+    def replay(self, run: Callable):
+        """Run every masked hook once
+
+        Args:
+            run (Callable): Runs a command in the new root, taking the command
+            and the text to pass to its stdin, and returning its stdout and stderr
+        """
+        installed = {}
+
+        def get_installed(query: str) -> list:
+            # Only ask pacman for each list of targets once
+            if query not in installed:
+                result = run(f"pacman {query}", None)
+                installed[query] = result[0].decode().split() if result else []
+            return installed[query]
+
+        # pacman runs hooks in alphabetical order regardless of where they live
+        for hook_name in sorted(self.hooks):
+            hook_path = f"{self.target}{SYSTEM_HOOK_DIR}/{hook_name}"
+
+            if not path.isfile(hook_path):
+                continue
+
+            hook   = parse_hook(hook_path)
+            action = hook["action"]
+
+            if action.get("When") != "PostTransaction":
+                output.warn(f"Not replaying {hook_name}, only post transaction hooks can be deferred")
+                continue
+
+            targets = []
+            for trigger in hook["triggers"]:
+                if trigger["Type"] == "Package":
+                    candidates = get_installed("-Qq")
+                else:
+                    # alpm matches paths relative to the root
+                    candidates = [file.lstrip("/") for file in get_installed("-Qlq")]
+
+                targets += match_targets(trigger["Target"], candidates)
+
+            # The hook would not have been triggered by anything installed
+            if not targets:
+                continue
+
+            output.info(f"Running deferred hook {hook_name}", 1)
+
+            if action.get("NeedsTargets"):
+                run(action["Exec"], "\n".join(sorted(set(targets))))
+            else:
+                run(action["Exec"], None)
+
+# EOF
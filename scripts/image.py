@@ -0,0 +1,91 @@
+from os.path import isfile
+from hashlib import sha256
+from json    import dumps
+
+import command_utils as cmd
+
+#------------------------------------------------------------------------------
+
+# Paths that are either mounted while the image is taken, identify the host
+# or only exist while the installer is running
+EXCLUDES = [
+    "./proc/*",
+    "./sys/*",
+    "./dev/*",
+    "./run/*",
+    "./tmp/*",
+    "./var/cache/pacman/pkg/*",
+    "./etc/machine-id",
+    "./etc/ssh/ssh_host_*",
+    "./etc/resolv.conf"
+]
+
+TAR_OPTIONS = "--zstd --numeric-owner --acls --xattrs --xattrs-include='*'"
+
+#------------------------------------------------------------------------------
+
+def get_image_key(sections: dict) -> str:
+    """Hash the parts of the config that end up in the image
+
+    Args:
+        sections (dict): Every config value that changes the contents of the image
+
+    Returns:
+        str: A short hex digest, stable across runs
+    """
+    return sha256(dumps(sections, sort_keys=True).encode()).hexdigest()[:16]
+
+#------------------------------------------------------------------------------
+
+class RootImage:
+    """A zstd compressed tarball of a configured root, minus anything host specific
+
+    Installs with the same package-relevant config extract it in place of
+    pacstrap and skip every host independent configuration step.
+    """
+
+    def __init__(self, directory: str, key: str, dry_run: bool=False):
+        self.directory = directory.rstrip("/")
+        self.key       = key
+        self.dry_run   = dry_run
+
+        self.path = f"{self.directory}/excalibur-{key}.tar.zst"
+
+    #--------------------------------------------------------------------------
+
+    def exists(self) -> bool:
+        return isfile(self.path)
+
+    #--------------------------------------------------------------------------
+
+    def build(self, target_mountpoint: str, excludes: list | None = None):
+        """Save the new root as an image
+
+        Args:
+            target_mountpoint (str): The new root
+            excludes (list, optional): Paths inside the new root to leave out
+            on top of EXCLUDES. Defaults to None.
+        """
+        cmd.execute(f"mkdir -p {self.directory}", dry_run=self.dry_run)
+
+        tar_command = f"tar {TAR_OPTIONS} -cpf {self.path}.partial"
+
+        for exclude in EXCLUDES + [f".{exclude}" for exclude in excludes or []]:
+            tar_command += f" --exclude='{exclude}'"
+
+        tar_command += f" -C {target_mountpoint} ."
+
+        cmd.execute(tar_command, dry_run=self.dry_run)
+
+        # Only a complete image may ever be picked up by another install
+        cmd.execute(f"mv {self.path}.partial {self.path}", dry_run=self.dry_run)
+
+    #--------------------------------------------------------------------------
+
+    def extract(self, target_mountpoint: str):
+        cmd.execute(
+            f"tar {TAR_OPTIONS} -xpf {self.path} -C {target_mountpoint}",
+            dry_run=self.dry_run
+        )
+
+# EOF
@@ -0,0 +1,256 @@
+import os
+import json
+
+from os       import path
+from re       import search
+from glob     import glob
+from tempfile import mkdtemp
+
+import command_utils as cmd
+import output_utils  as output
+
+from command_utils import PipeOpts
+
+#------------------------------------------------------------------------------
+
+# argon2id never goes below this many iterations
+MIN_ITERATIONS = 4
+
+# Same size as the 4 512 byte blocks that used to be read from /dev/random
+KEYFILE_SIZE = 2048
+
+# tmpfs, so key material never touches a disk
+KEY_STAGING_DIR = "/dev/shm"
+
+# Every staging directory is named like this so that all of them can be
+# found again and removed, even those left behind by an aborted run
+KEY_STAGING_PREFIX = "excalibur-keys-"
+
+BENCHMARK_PATTERN = \
+    r"argon2id\s+(\d+) iterations, (\d+) memory, (\d+) parallel threads.*requested (\d+) ms time"
+
+#------------------------------------------------------------------------------
+
+def get_cpu_model() -> str:
+    with open("/proc/cpuinfo", "r") as cpuinfo_file:
+        for line in cpuinfo_file:
+            if line.startswith("model name"):
+                return line.split(":", 1)[1].strip()
+
+    return "unknown"
+
+#------------------------------------------------------------------------------
+
+def get_available_memory() -> int:
+    """Get the memory that can be used without swapping
+
+    Returns:
+        int: MemAvailable in KiB
+    """
+    with open("/proc/meminfo", "r") as meminfo_file:
+        for line in meminfo_file:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1])
+
+    return 0
+
+#------------------------------------------------------------------------------
+
+def get_max_parallel(pbkdf_memory: int, max_jobs: int | None = None) -> int:
+    """Get how many devices can be formatted at once, since every argon2id
+    derivation holds its full memory cost for as long as it runs
+
+    Args:
+        pbkdf_memory (int): Memory cost of a single derivation in KiB
+        max_jobs (int, optional): Upper limit regardless of memory. Defaults to None.
+
+    Returns:
+        int: The number of concurrent luksFormat calls, at least 1
+    """
+    jobs = max(1, get_available_memory() // pbkdf_memory)
+
+    return min(jobs, max_jobs) if max_jobs else jobs
+
+#------------------------------------------------------------------------------
+
+def parse_benchmark(benchmark_output: str) -> dict | None:
+    """Parse the argon2id line of cryptsetup benchmark
+
+    Args:
+        benchmark_output (str): Output of cryptsetup benchmark --pbkdf argon2id
+
+    Returns:
+        dict | None: Iterations, memory (KiB), threads and the time in ms they
+        were measured against, or None if there was no argon2id result
+    """
+    if not (result := search(BENCHMARK_PATTERN, benchmark_output)):
+        return None
+
+    iterations, memory, threads, time = (int(group) for group in result.groups())
+
+    return {
+        "iterations" : iterations,
+        "memory"     : memory,
+        "threads"    : threads,
+        "time"       : time
+    }
+
+#------------------------------------------------------------------------------
+
+def generate_keyfile(name: str) -> tuple[str, bytes]:
+    """Generate a random key in a private staging directory on tmpfs
+
+    Args:
+        name (str): Name of the key, usually the mapper name
+
+    Returns:
+        tuple[str, bytes]: Path of the staged keyfile and the key itself
+    """
+    key = os.getrandom(KEYFILE_SIZE)
+
+    # mkdtemp creates the directory with mode 0700
+    keyfile_path = f"{mkdtemp(prefix=KEY_STAGING_PREFIX, dir=KEY_STAGING_DIR)}/{name}.key"
+
+    keyfile = os.open(keyfile_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o400)
+    with os.fdopen(keyfile, "wb") as keyfile:
+        keyfile.write(key)
+
+    return keyfile_path, key
+
+#------------------------------------------------------------------------------
+
+def install_keyfile(keyfile_path: str, destination: str):
+    """Move a staged keyfile into the new root with mode 0400
+
+    Args:
+        keyfile_path (str): Path of the staged keyfile
+        destination (str): Path of the keyfile in the new root
+    """
+    if not path.isfile(keyfile_path):
+        raise Exception(f"Staged keyfile {keyfile_path} is gone, the device has to be encrypted again")
+
+    with open(keyfile_path, "rb") as keyfile:
+        key = keyfile.read()
+
+    os.makedirs(path.dirname(destination), mode=0o700, exist_ok=True)
+
+    installed_keyfile = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o400)
+    with os.fdopen(installed_keyfile, "wb") as installed:
+        installed.write(key)
+
+    # The key only needs to live in the new root from now on
+    shred_keyfile(keyfile_path)
+    os.rmdir(path.dirname(keyfile_path))
+
+#------------------------------------------------------------------------------
+
+def shred_keyfile(keyfile_path: str):
+    """Overwrite a keyfile with zeros before removing it
+    """
+    keyfile = os.open(keyfile_path, os.O_WRONLY)
+    with os.fdopen(keyfile, "wb") as keyfile:
+        keyfile.write(bytes(path.getsize(keyfile_path)))
+        keyfile.flush()
+        os.fsync(keyfile.fileno())
+
+    os.remove(keyfile_path)
+
+#------------------------------------------------------------------------------
+
+def remove_staged_keyfiles():
+    """Shred every staged keyfile and remove the staging directories,
+    whether or not the keys made it into the new root
+    """
+    for staging_dir in glob(f"{KEY_STAGING_DIR}/{KEY_STAGING_PREFIX}*"):
+        for entry in os.scandir(staging_dir):
+            shred_keyfile(entry.path)
+
+        os.rmdir(staging_dir)
+
+#------------------------------------------------------------------------------
+
+class PbkdfCalibration:
+    """Benchmark argon2id once per CPU model and derive fixed PBKDF costs from it
+
+    luksFormat normally benchmarks the PBKDF itself for every device, which
+    both costs time and gives skewed results when devices are formatted
+    concurrently. Forcing the cost from a single calibration avoids both.
+    """
+
+    def __init__(self, cache_file: str, dry_run: bool = False):
+        self.cache_file = cache_file
+        self.dry_run    = dry_run
+
+    #--------------------------------------------------------------------------
+
+    def __load(self) -> dict:
+        if not path.isfile(self.cache_file):
+            return {}
+
+        with open(self.cache_file, "r") as cache:
+            return json.load(cache)
+
+    #--------------------------------------------------------------------------
+
+    def __save(self, benchmarks: dict):
+        cmd.execute(f"mkdir -p {path.dirname(self.cache_file)}", dry_run=self.dry_run)
+
+        with open(self.cache_file, "w") as cache:
+            json.dump(benchmarks, cache, indent=4)
+
+    #--------------------------------------------------------------------------
+
+    def get_benchmark(self, unlock_time: int, memory: int) -> dict | None:
+        cpu_model  = get_cpu_model()
+        benchmarks = self.__load()
+
+        if cpu_model in benchmarks:
+            return benchmarks[cpu_model]
+
+        output.info(f"Benchmarking argon2id on {cpu_model}...", 1)
+
+        benchmark_output = cmd.execute(
+            "cryptsetup benchmark --pbkdf argon2id " \
+                + f"--iter-time {unlock_time} --pbkdf-memory {memory}",
+            PipeOpts.STDOUT | PipeOpts.STDERR,
+            self.dry_run
+        )
+
+        if not isinstance(benchmark_output, tuple):
+            return None
+
+        if (benchmark := parse_benchmark(benchmark_output[0].decode())):
+            benchmarks[cpu_model] = benchmark
+            self.__save(benchmarks)
+
+        return benchmark
+
+    #--------------------------------------------------------------------------
+
+    def get_format_options(self, unlock_time: int, memory: int) -> str:
+        """Get the luksFormat options that make unlocking take about unlock_time
+
+        Args:
+            unlock_time (int): Target unlock time in ms
+            memory (int): argon2id memory cost in KiB
+
+        Returns:
+            str: cryptsetup PBKDF options
+        """
+        pbkdf_options = f"--pbkdf argon2id --pbkdf-memory {memory}"
+
+        # Let cryptsetup benchmark on its own if calibration isn't possible
+        if not (benchmark := self.get_benchmark(unlock_time, memory)):
+            return f"{pbkdf_options} --iter-time {unlock_time}"
+
+        # argon2id time grows linearly with both iterations and memory
+        iterations = round(
+            benchmark["iterations"]
+            * (unlock_time / benchmark["time"])
+            * (benchmark["memory"] / memory)
+        )
+
+        return f"{pbkdf_options} --pbkdf-parallel {benchmark['threads']} " \
+            + f"--pbkdf-force-iterations {max(MIN_ITERATIONS, iterations)}"
+
+# EOF
@@ -0,0 +1,187 @@
+from os          import path
+from re          import match, search
+from time        import sleep
+from threading   import Thread, Lock, Event
+from dataclasses import dataclass
+
+import command_utils as cmd
+import output_utils  as output
+
+#------------------------------------------------------------------------------
+
+MDSTAT = "/proc/mdstat"
+
+SPEED_LIMITS = {
+    "min" : "dev.raid.speed_limit_min",
+    "max" : "dev.raid.speed_limit_max"
+}
+
+PROGRESS_PATTERN = \
+    r"(resync|recovery|check|reshape|repair)\s*=\s*([\d.]+)%\s*\((\d+)/(\d+)\)" \
+    + r"\s*finish=(\S+)\s*speed=(\S+)"
+
+#------------------------------------------------------------------------------
+
+@dataclass
+class ResyncProgress:
+    array  : str
+    action : str
+    percent: float = 0.0
+    done   : int = 0
+    total  : int = 0
+    finish : str = ""
+    speed  : str = ""
+
+    def __str__(self) -> str:
+        if not self.total:
+            return f"{self.array}: {self.action} pending"
+
+        return f"{self.array}: {self.action} {self.percent}% " \
+            + f"({self.done}/{self.total}) finish={self.finish} speed={self.speed}"
+
+#------------------------------------------------------------------------------
+
+def parse_mdstat(mdstat: str) -> dict[str, ResyncProgress]:
+    """Parse the arrays that are resyncing out of /proc/mdstat
+
+    Args:
+        mdstat (str): Contents of /proc/mdstat
+
+    Returns:
+        dict[str, ResyncProgress]: Progress by kernel array name, ie. md127
+    """
+    progress = {}
+    array = None
+
+    for line in mdstat.splitlines():
+        if (array_match := match(r"(md\w+) : ", line)):
+            array = array_match.group(1)
+            continue
+
+        if not array:
+            continue
+
+        if (progress_match := search(PROGRESS_PATTERN, line)):
+            action, percent, done, total, finish, speed = progress_match.groups()
+
+            progress[array] = ResyncProgress(
+                array, action, float(percent), int(done), int(total), finish, speed
+            )
+        elif (delayed_match := search(r"(resync|recovery|reshape)\s*=\s*(DELAYED|PENDING)", line)):
+            progress[array] = ResyncProgress(array, delayed_match.group(1))
+
+    return progress
+
+#------------------------------------------------------------------------------
+
+def read_mdstat() -> dict[str, ResyncProgress]:
+    if not path.isfile(MDSTAT):
+        return {}
+
+    with open(MDSTAT, "r") as mdstat_file:
+        return parse_mdstat(mdstat_file.read())
+
+#------------------------------------------------------------------------------
+
+def set_speed_limits(speed_min: int | None,
+                     speed_max: int | None,
+                     dry_run  : bool = False) -> dict:
+    """Set the kernel's RAID resync speed limits
+
+    Args:
+        speed_min (int | None): Minimum resync speed in KiB/s, None to leave it
+        speed_max (int | None): Maximum resync speed in KiB/s, None to leave it
+        dry_run (bool, optional): Only print the commands. Defaults to False.
+
+    Returns:
+        dict: The previous value of every limit that was changed
+    """
+    previous = {}
+
+    for limit, speed in (("min", speed_min), ("max", speed_max)):
+        if speed is None:
+            continue
+
+        sysctl = SPEED_LIMITS[limit]
+
+        with open(f"/proc/sys/{sysctl.replace('.', '/')}", "r") as limit_file:
+            previous[limit] = int(limit_file.read())
+
+        cmd.execute(f"sysctl -q -w {sysctl}={speed}", dry_run=dry_run)
+
+    return previous
+
+#------------------------------------------------------------------------------
+
+def restore_speed_limits(previous: dict, dry_run: bool = False):
+    for limit in previous:
+        cmd.execute(f"sysctl -q -w {SPEED_LIMITS[limit]}={previous[limit]}", dry_run=dry_run)
+
+#------------------------------------------------------------------------------
+
+class ResyncMonitor:
+    """Keep track of RAID resyncs in the background
+
+    Arrays are usable straight away while the kernel resyncs them, so the
+    install carries on and the progress is polled from /proc/mdstat.
+    """
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+
+        self.thread = None
+        self.__lock     = Lock()
+        self.__stopped  = Event()
+        self.__progress = {}
+
+    #--------------------------------------------------------------------------
+
+    def __poll(self):
+        while not self.__stopped.is_set():
+            progress = read_mdstat()
+
+            with self.__lock:
+                self.__progress = progress
+
+            self.__stopped.wait(self.interval)
+
+    #--------------------------------------------------------------------------
+
+    @property
+    def progress(self) -> dict[str, ResyncProgress]:
+        with self.__lock:
+            return dict(self.__progress)
+
+    #--------------------------------------------------------------------------
+
+    def start(self):
+        self.thread = Thread(target=self.__poll, daemon=True)
+        self.thread.start()
+
+    #--------------------------------------------------------------------------
+
+    def stop(self):
+        self.__stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    #--------------------------------------------------------------------------
+
+    def report(self):
+        for array_progress in self.progress.values():
+            output.info(str(array_progress), 1)
+
+    #--------------------------------------------------------------------------
+
+    def wait(self):
+        """Block until no array is resyncing anymore, reporting as it goes
+        """
+        while (progress := read_mdstat()):
+            for array_progress in progress.values():
+                output.info(str(array_progress), 1)
+
+            sleep(self.interval)
+
+        self.stop()
+
+# EOF
@@ -0,0 +1,133 @@
+from typing import Callable
+
+from scheduler import Scheduler
+
+#------------------------------------------------------------------------------
+
+class MountNode:
+
+    def __init__(self, mountpoint: str,
+                       mount     : Callable,
+                       unmount   : Callable,
+                       source    = None):
+
+        self.mountpoint = mountpoint
+        self.mount      = mount
+        self.unmount    = unmount
+
+        # Whatever the node was created from, ie. a Formattable or a subvolume
+        self.source = source
+
+        self.parent   = None
+        self.children = []
+
+    #--------------------------------------------------------------------------
+
+    def contains(self, mountpoint: str) -> bool:
+        """Check if a mountpoint lies somewhere beneath this node's mountpoint
+        """
+        if self.mountpoint == "/":
+            return mountpoint != "/"
+
+        return mountpoint.startswith(f"{self.mountpoint.rstrip('/')}/")
+
+#------------------------------------------------------------------------------
+
+class MountTree:
+    """Mountpoints arranged by which filesystem each one lives on
+
+    A mountpoint's parent is the closest mountpoint above it, so /home/bob
+    depends on /home (or / if there is no /home) but not on /var/log.
+    Parents are always mounted before their children and unmounted after
+    them, while independent siblings are handled concurrently.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    #--------------------------------------------------------------------------
+
+    def add(self, mountpoint: str,
+                  mount     : Callable,
+                  unmount   : Callable,
+                  source    = None):
+
+        if mountpoint in self.nodes:
+            raise Exception(f"Multiple filesystems set to mount on {mountpoint}")
+
+        self.nodes[mountpoint] = MountNode(mountpoint, mount, unmount, source)
+        self.__link()
+
+    #--------------------------------------------------------------------------
+
+    def __link(self):
+        for node in self.nodes.values():
+            node.parent   = None
+            node.children = []
+
+        for node in self.nodes.values():
+            for candidate in self.nodes.values():
+                if candidate.contains(node.mountpoint) and (
+                    not node.parent or node.parent.contains(candidate.mountpoint)
+                ):
+                    node.parent = candidate
+
+        # Sorting keeps the order of the tree independent of insertion order
+        for node in sorted(self.nodes.values(), key=lambda node: node.mountpoint):
+            if node.parent:
+                node.parent.children.append(node)
+
+    #--------------------------------------------------------------------------
+
+    def roots(self) -> list[MountNode]:
+        return sorted(
+            (node for node in self.nodes.values() if not node.parent),
+            key=lambda node: node.mountpoint
+        )
+
+    #--------------------------------------------------------------------------
+
+    def walk(self) -> list[MountNode]:
+        """Get every node with parents ahead of their children
+
+        Returns:
+            list[MountNode]: The nodes of the tree in depth-first order
+        """
+        nodes = []
+        stack = list(reversed(self.roots()))
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+
+        return nodes
+
+    #--------------------------------------------------------------------------
+
+    def mount(self, max_workers: int | None = None):
+        scheduler = Scheduler(max_workers)
+
+        for node in self.walk():
+            scheduler.add(
+                node.mountpoint,
+                node.mount,
+                [node.parent.mountpoint] if node.parent else []
+            )
+
+        scheduler.run()
+
+    #--------------------------------------------------------------------------
+
+    def unmount(self, max_workers: int | None = None):
+        scheduler = Scheduler(max_workers)
+
+        for node in reversed(self.walk()):
+            scheduler.add(
+                node.mountpoint,
+                node.unmount,
+                [child.mountpoint for child in node.children]
+            )
+
+        scheduler.run()
+
+# EOF
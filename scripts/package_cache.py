@@ -0,0 +1,121 @@
+import os
+
+from time import time
+
+import command_utils as cmd
+import output_utils  as output
+
+from size_utils import parse_size
+
+#------------------------------------------------------------------------------
+
+# Where packages live inside the new root
+TARGET_CACHE_DIR = "/var/cache/pacman/pkg"
+
+#------------------------------------------------------------------------------
+
+class PackageCache:
+    """A package cache directory on the host that is shared between installs
+
+    pacstrap downloads into it directly and it is bind mounted over the
+    target's package cache while the new root is being configured, so every
+    package only has to be downloaded once across installs.
+    """
+
+    def __init__(self, directory: str,
+                       max_size : str | int = 0,
+                       max_age  : int = 0,
+                       dry_run  : bool = False):
+
+        self.directory = directory.rstrip("/")
+        self.max_size  = parse_size(max_size)
+        self.max_age   = max_age
+        self.dry_run   = dry_run
+
+    #--------------------------------------------------------------------------
+
+    def prepare(self):
+        cmd.execute(f"mkdir -p {self.directory}", dry_run=self.dry_run)
+
+    #--------------------------------------------------------------------------
+
+    def bind(self, target_mountpoint: str):
+        cmd.execute(
+            f"mkdir -p {target_mountpoint}{TARGET_CACHE_DIR}",
+            dry_run=self.dry_run
+        )
+        cmd.execute(
+            f"mount --bind {self.directory} {target_mountpoint}{TARGET_CACHE_DIR}",
+            dry_run=self.dry_run
+        )
+
+    #--------------------------------------------------------------------------
+
+    def unbind(self, target_mountpoint: str):
+        cmd.execute(
+            f"umount {target_mountpoint}{TARGET_CACHE_DIR}",
+            dry_run=self.dry_run
+        )
+
+    #--------------------------------------------------------------------------
+
+    def __packages(self) -> list[tuple[float, int, list[str]]]:
+        """Get every cached package along with its signature
+
+        Returns:
+            list: The last use time, combined size and paths of each package
+        """
+        packages = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".sig"):
+                continue
+
+            paths = [entry.path]
+            if os.path.isfile(f"{entry.path}.sig"):
+                paths.append(f"{entry.path}.sig")
+
+            stats = [os.stat(path) for path in paths]
+            packages.append((
+                max(stats[0].st_atime, stats[0].st_mtime),
+                sum(stat.st_size for stat in stats),
+                paths
+            ))
+
+        return packages
+
+    #--------------------------------------------------------------------------
+
+    def prune(self):
+        """Evict packages older than max_age days, then the least recently
+        used packages until the cache fits in max_size
+        """
+        if self.dry_run or not os.path.isdir(self.directory):
+            return
+
+        # Least recently used first
+        packages = sorted(self.__packages())
+
+        evicted   = 0
+        remaining = []
+        for last_used, size, paths in packages:
+            if self.max_age and time() - last_used > self.max_age * 86400:
+                for path in paths:
+                    os.remove(path)
+                evicted += 1
+            else:
+                remaining.append((last_used, size, paths))
+
+        total_size = sum(size for _, size, _ in remaining)
+        for last_used, size, paths in remaining:
+            if not self.max_size or total_size <= self.max_size:
+                break
+
+            for path in paths:
+                os.remove(path)
+            total_size -= size
+            evicted += 1
+
+        if evicted:
+            output.info(f"Evicted {evicted} packages from {self.directory}", 1)
+
+# EOF
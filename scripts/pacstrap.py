@@ -1,10 +1,49 @@
-from re import sub
+from re        import sub
+from os        import path, scandir
+from math      import inf
+from time      import time
+from threading import Thread
+from shutil    import rmtree
+from tempfile  import mkdtemp, gettempdir
 
 import command_utils as cmd
+import output_utils  as output
+
+from command_utils import PipeOpts
 
 
 KERNELS = ["zen", "hardened", "lts"]
 
+# Where pacman keeps the sync databases
+SYNC_DIR = "/var/lib/pacman/sync"
+
+# Shells that are already provided by base (bash, util-linux, systemd) or
+# by git, which is always installed
+BASE_SHELLS = [
+    "sh",
+    "bash",
+    "rbash",
+    "nologin",
+    "git-shell",
+    "systemd-home-fallback-shell"
+]
+
+# Packages providing each shell, by the shell's file name
+SHELL_PACKAGES = {
+    "csh"     : "tcsh",
+    "mksh"    : "mksh",
+    "lksh"    : "mksh",
+    "nu"      : "nushell",
+    "yash"    : "yash",
+    "zsh"     : "zsh",
+    "fish"    : "fish",
+    "dash"    : "dash",
+    "tcsh"    : "tcsh",
+    "xonsh"   : "xonsh",
+    "elvish"  : "elvish",
+    "busybox" : "busybox"
+}
+
 #------------------------------------------------------------------------------
 
 def tune_pacman(root: str="/", parallel_downloads: int=5):
@@ -32,64 +71,299 @@ def tune_pacman(root: str="/", parallel_downloads: int=5):
 
 #------------------------------------------------------------------------------
 
-def update_pacman(dry_run: bool=False):
+def get_database_age(root: str="") -> float:
+    """Get how long ago the sync databases were last refreshed
+
+    Args:
+        root (str, optional): The system root to check ({root}/var/lib/pacman/sync). Defaults to "".
+
+    Returns:
+        float: Age of the oldest sync database in seconds, infinite if there are none
+    """
+    sync_dir = f"{root}{SYNC_DIR}"
+    if not path.isdir(sync_dir):
+        return inf
+
+    databases = [entry for entry in scandir(sync_dir) if entry.name.endswith(".db")]
+    if not databases:
+        return inf
+
+    return time() - min(database.stat().st_mtime for database in databases)
+
+#------------------------------------------------------------------------------
+
+def keyring_outdated(dry_run: bool=False) -> bool:
+    """Check if the sync databases have a newer archlinux-keyring than the one installed
+    """
+    if dry_run:
+        return True
+
+    upgrades = cmd.execute(
+        "pacman -Qu archlinux-keyring",
+        PipeOpts.STDOUT | PipeOpts.STDERR,
+        print_errors=False
+    )
+
+    return bool(upgrades[0].strip())
+
+#------------------------------------------------------------------------------
+
+def update_pacman(dry_run: bool=False, sync_ttl: int=0):
     """Make sure that mirrors and keyring are up to date so prevent errors when installing
 
     Args:
         dry_run (bool, optional): Print, don't run commands. Defaults to False.
+        sync_ttl (int, optional): Only resync databases older than this many seconds. Defaults to 0.
     """
-    cmd.execute("pacman --noconfirm -Sy archlinux-keyring", dry_run=dry_run)
+    if dry_run or get_database_age() > sync_ttl:
+        cmd.execute("pacman -Sy", dry_run=dry_run)
+
+    # Only reinstall the keyring if there actually is a newer one
+    if keyring_outdated(dry_run):
+        cmd.execute("pacman --noconfirm -S archlinux-keyring", dry_run=dry_run)
 
 #------------------------------------------------------------------------------
 
-def pacstrap(target_mountpoint: str="/mnt",
-             linux_kernel: str="",
-             linux_firmware: bool=True,
-             bootloader: str="grub",
-             efi: bool=True,
-             network_manager: bool=True,
-             enable_ssh: bool=True,
-             reflector: bool=True,
-             dry_run: bool=False
-             ):
+def copy_databases(target_mountpoint: str, dry_run: bool=False):
+    """Copy the freshly synced databases of the live environment into the new
+    root so that pacstrap finds them up to date instead of downloading them again
 
-    # Start building pacstrap command with base and base-devel as baseline packages
-    pacstrap_command = f"pacstrap {target_mountpoint} base base-devel linux"
+    Args:
+        target_mountpoint (str): The new root
+        dry_run (bool, optional): Print, don't run commands. Defaults to False.
+    """
+    cmd.execute(f"mkdir -p {target_mountpoint}{SYNC_DIR}", dry_run=dry_run)
+    cmd.execute(
+        f"cp -a {SYNC_DIR}/. {target_mountpoint}{SYNC_DIR}/",
+        dry_run=dry_run
+    )
+
+#------------------------------------------------------------------------------
+
+def get_packages(linux_kernel: str="",
+                 linux_firmware: bool=True,
+                 bootloader: str="grub",
+                 efi: bool=True,
+                 network_manager: bool=True,
+                 enable_ssh: bool=True,
+                 reflector: bool=True
+                 ) -> list:
+    """Build the list of packages that the new root is bootstrapped with
+
+    Returns:
+        list: The package names
+    """
+
+    # Start with base and base-devel as baseline packages
+    packages = ["base", "base-devel"]
 
     # Append linux kernel and kernel header packages
     # Allow the user to specify zen, hardened or lts kernel
     if linux_kernel == "":
-        pacstrap_command += " linux-headers"
+        packages += ["linux", "linux-headers"]
     elif linux_kernel in KERNELS:
-        pacstrap_command += f"-{linux_kernel} linux-{linux_kernel}-headers"
+        packages += [f"linux-{linux_kernel}", f"linux-{linux_kernel}-headers"]
     else:
         print(f"{linux_kernel} is not a valid kernel option")
 
     # Append linux-firmware by default
     if linux_firmware:
-        pacstrap_command += " linux-firmware"
+        packages.append("linux-firmware")
 
     # Append a bootloader (grub by default)
     # Can be set to None to skip installing bootloader
     if bootloader:
-        pacstrap_command += f" {bootloader}"
+        packages.append(bootloader)
 
     # Append efibootmgr by default to allow for booting with efi
     if efi:
-        pacstrap_command += " efibootmgr"
+        packages.append("efibootmgr")
 
     # Append networkmanager by default
     if network_manager:
-        pacstrap_command += " networkmanager"
+        packages.append("networkmanager")
 
     # Apppend openssh by default
     if enable_ssh:
-        pacstrap_command += " openssh"
+        packages.append("openssh")
     
     # Append reflector by default to ensure the fastest mirrors will be used
     if reflector:
-        pacstrap_command += " reflector"
+        packages.append("reflector")
+
+    return packages
+
+#------------------------------------------------------------------------------
+
+def get_shell_packages(shells: list) -> list:
+    """Get the packages providing every shell that isn't part of a base install
+
+    Args:
+        shells (list): Paths to the shells, ie. /usr/bin/zsh
+
+    Returns:
+        list: The package names
+    """
+    packages = []
+    for shell in shells:
+        if not shell:
+            continue
+
+        shell_name = shell.split("/")[-1]
+        if shell_name in BASE_SHELLS:
+            continue
+
+        if shell_name not in SHELL_PACKAGES:
+            output.warn(f"No known package provides {shell}, trying a package named {shell_name}")
+
+        packages.append(SHELL_PACKAGES.get(shell_name, shell_name))
+
+    return list(dict.fromkeys(packages))
+
+#------------------------------------------------------------------------------
+
+def split_repo_packages(packages: list, dry_run: bool=False) -> tuple[list, list]:
+    """Separate packages found in the sync databases from those that have to
+    come from the AUR
+
+    Args:
+        packages (list): Package and group names
+        dry_run (bool, optional): Print, don't run commands. Defaults to False.
+
+    Returns:
+        tuple[list, list]: The repo packages and the remaining packages
+    """
+    repo_names = cmd.execute("pacman -Slq", PipeOpts.STDOUT, dry_run)
+    group_names = cmd.execute("pacman -Sg", PipeOpts.STDOUT, dry_run)
+
+    if not repo_names or not group_names:
+        return packages, []
+
+    available = set(repo_names[0].decode().split())
+    available |= {line.split()[0] for line in group_names[0].decode().splitlines() if line}
+
+    repo_packages = [package for package in packages if package in available]
+    aur_packages  = [package for package in packages if package not in available]
+
+    return repo_packages, aur_packages
+
+#------------------------------------------------------------------------------
+
+def pacstrap(target_mountpoint: str="/mnt",
+             packages: list | None=None,
+             cache_dir: str="",
+             hook_dir: str="",
+             dry_run: bool=False
+             ):
+
+    if packages is None:
+        packages = ["base"]
+
+    pacstrap_command = "pacstrap"
+
+    # Download into and install from a shared cache on the host if there is one
+    if cache_dir:
+        pacstrap_command += f" -c {target_mountpoint} --cachedir {cache_dir}"
+    else:
+        pacstrap_command += f" {target_mountpoint}"
+
+    # pacman only reads the system hooks from the new root, hook overrides
+    # are taken from the host unless another directory is given
+    if hook_dir:
+        pacstrap_command += f" --hookdir {hook_dir}"
+
+    pacstrap_command += f" {' '.join(packages)}"
 
     cmd.execute(pacstrap_command, dry_run=dry_run)
 
+#------------------------------------------------------------------------------
+
+class Prefetcher:
+    """Download packages into a cache in the background
+
+    This runs while the drives are being prepared so that pacstrap can
+    install straight from the warm cache later on.
+    """
+
+    def __init__(self, packages: list,
+                       cache_dir: str,
+                       sync_ttl: int=0,
+                       dry_run: bool=False):
+
+        self.packages  = packages
+        self.cache_dir = cache_dir
+        self.sync_ttl  = sync_ttl
+        self.dry_run   = dry_run
+
+        self.thread = None
+        self.errors = []
+
+    #--------------------------------------------------------------------------
+
+    def __run_quietly(self, command: str):
+        # Output is collected rather than printed so it doesn't get mixed
+        # in with the prompts and progress of the main thread
+        proc = cmd.execute(command, PipeOpts.STDOUT | PipeOpts.STDERR, self.dry_run, False)
+        if not proc:
+            return
+
+        stderr = proc.communicate()[1]
+        if proc.returncode != 0:
+            self.errors.append(f"{command}\n{stderr.decode()}")
+
+    #--------------------------------------------------------------------------
+
+    def __prefetch(self):
+        if self.dry_run or get_database_age() > self.sync_ttl:
+            self.__run_quietly("pacman -Sy")
+
+        # The keyring has to be current for the downloads to pass verification
+        if keyring_outdated(self.dry_run):
+            self.__run_quietly("pacman --noconfirm -S archlinux-keyring")
+
+        # Anything not in the repos is left for the AUR helper
+        packages = split_repo_packages(self.packages, self.dry_run)[0]
+
+        # Dependencies are resolved against an empty root holding only the
+        # synced databases, otherwise anything already installed in the live
+        # environment would be left for pacstrap to download
+        if self.dry_run:
+            scratch_root = f"{gettempdir()}/excalibur-prefetch-XXXXXXXX"
+        else:
+            scratch_root = mkdtemp(prefix="excalibur-prefetch-")
+        scratch_dbpath = f"{scratch_root}{path.dirname(SYNC_DIR)}"
+
+        self.__run_quietly(f"mkdir -p {scratch_dbpath}/local {scratch_dbpath}/sync")
+        self.__run_quietly(f"cp -a {SYNC_DIR}/. {scratch_dbpath}/sync/")
+
+        self.__run_quietly(
+            f"pacman --noconfirm -Sw --root {scratch_root} --dbpath {scratch_dbpath} " \
+                + f"--cachedir {self.cache_dir} {' '.join(packages)}"
+        )
+
+        if self.dry_run:
+            output.print_command(f"rm -rf {scratch_root}")
+        else:
+            rmtree(scratch_root, ignore_errors=True)
+
+    #--------------------------------------------------------------------------
+
+    def start(self):
+        self.thread = Thread(target=self.__prefetch, daemon=True)
+        self.thread.start()
+
+    #--------------------------------------------------------------------------
+
+    def wait(self):
+        """Wait for the downloads to finish
+
+        Failures are only warned about since pacstrap will still download
+        anything that is missing from the cache.
+        """
+        if self.thread:
+            self.thread.join()
+
+        for error in self.errors:
+            output.warn(f"Prefetching packages failed:\n{error}")
+
 # EOF
\ No newline at end of file
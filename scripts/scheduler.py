@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing             import Callable
+
+#------------------------------------------------------------------------------
+
+class Job:
+
+    def __init__(self, name        : str,
+                       function    : Callable,
+                       dependencies: set,
+                       resources   : set):
+
+        self.name         = name
+        self.function     = function
+        self.dependencies = dependencies
+        self.resources    = resources
+
+#------------------------------------------------------------------------------
+
+class Scheduler:
+    """Run jobs concurrently while respecting a dependency graph
+
+    A job starts once every job it depends on has finished and none of its
+    resources (ie. the physical drives it touches) are held by a running job.
+    Dependencies on names that aren't jobs of this scheduler are treated as
+    already satisfied, since they were handled by an earlier phase.
+    """
+
+    def __init__(self, max_workers: int | None = None):
+        self.max_workers = max_workers
+        self.jobs        = {}
+
+    #--------------------------------------------------------------------------
+
+    def add(self, name        : str,
+                  function    : Callable,
+                  dependencies: list | set = (),
+                  resources   : list | set = ()):
+
+        self.jobs[name] = Job(name, function, set(dependencies), set(resources))
+
+    #--------------------------------------------------------------------------
+
+    def run(self) -> dict:
+        """Run every job and wait for all of them to finish
+
+        Returns:
+            dict: The return value of each job by name
+
+        Raises:
+            Exception: Re-raises the first exception of a failed job once the
+            running jobs have finished, or if the dependency graph has a cycle
+        """
+        pending  = dict(self.jobs)
+        finished = set()
+        held     = set()
+        running  = {}
+        results  = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # Jobs are considered in insertion order to keep runs reproducible
+                for name, job in list(pending.items()):
+                    unmet = {dep for dep in job.dependencies if dep in self.jobs} - finished
+                    if unmet or job.resources & held:
+                        continue
+
+                    held |= job.resources
+                    running[pool.submit(job.function)] = job
+                    del pending[name]
+
+                if not running:
+                    raise Exception(
+                        f"Circular dependency between {', '.join(pending)}"
+                    )
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    job = running.pop(future)
+                    held -= job.resources
+
+                    if exception := future.exception():
+                        # Let the jobs already running finish, but start no more
+                        wait(running)
+                        raise exception
+
+                    results[job.name] = future.result()
+                    finished.add(job.name)
+
+        return results
+
+# EOF
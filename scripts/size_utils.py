@@ -0,0 +1,25 @@
+SIZE_SUFFIXES = {
+    "K" : 1024,
+    "M" : 1024 ** 2,
+    "G" : 1024 ** 3,
+    "T" : 1024 ** 4
+}
+
+#------------------------------------------------------------------------------
+
+def parse_size(size: str | int) -> int:
+    """Convert a size like 512M or 20G into bytes
+
+    Args:
+        size (str | int): The size, optionally suffixed with K, M, G or T
+
+    Returns:
+        int: The size in bytes
+    """
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+
+    return int(size or 0)
+
+# EOF
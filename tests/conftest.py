@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import each other by module name, the same as in main.py
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "scripts"))
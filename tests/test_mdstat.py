@@ -0,0 +1,48 @@
+from mdstat import parse_mdstat, ResyncProgress
+
+#------------------------------------------------------------------------------
+
+MDSTAT = """Personalities : [raid1] [raid6] [raid5] [raid4]
+md126 : active raid5 sdd1[3] sdc1[1] sdb1[0]
+      1953260544 blocks super 1.2 level 5, 512k chunk, algorithm 2 [3/2] [UU_]
+      [=>...................]  recovery =  8.4% (82150400/976630272) finish=77.2min speed=193029K/sec
+      bitmap: 0/8 pages [0KB], 65536KB chunk
+
+md127 : active raid1 sdb2[1] sda2[0]
+      10476544 blocks super 1.2 [2/2] [UU]
+      \tresync=DELAYED
+
+md125 : active raid1 sde1[1] sdf1[0]
+      10476544 blocks super 1.2 [2/2] [UU]
+
+unused devices: <none>
+"""
+
+#------------------------------------------------------------------------------
+
+def test_parses_running_resync():
+    progress = parse_mdstat(MDSTAT)["md126"]
+
+    assert progress == ResyncProgress(
+        "md126", "recovery", 8.4, 82150400, 976630272, "77.2min", "193029K/sec"
+    )
+
+#------------------------------------------------------------------------------
+
+def test_parses_delayed_resync():
+    progress = parse_mdstat(MDSTAT)["md127"]
+
+    assert progress == ResyncProgress("md127", "resync")
+    assert str(progress) == "md127: resync pending"
+
+#------------------------------------------------------------------------------
+
+def test_skips_arrays_in_sync():
+    assert "md125" not in parse_mdstat(MDSTAT)
+
+#------------------------------------------------------------------------------
+
+def test_no_arrays():
+    assert parse_mdstat("Personalities :\nunused devices: <none>\n") == {}
+
+# EOF
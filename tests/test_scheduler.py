@@ -0,0 +1,89 @@
+import pytest
+
+from threading import Lock
+from time      import sleep
+
+from scheduler import Scheduler
+
+#------------------------------------------------------------------------------
+
+def test_returns_results_by_name():
+    scheduler = Scheduler(4)
+    scheduler.add("a", lambda: 1)
+    scheduler.add("b", lambda: 2)
+
+    assert scheduler.run() == {"a": 1, "b": 2}
+
+#------------------------------------------------------------------------------
+
+def test_dependencies_finish_first():
+    order = []
+
+    def job(name):
+        sleep(0.01)
+        order.append(name)
+
+    scheduler = Scheduler(4)
+    scheduler.add("fs", lambda: job("fs"), {"raid"})
+    scheduler.add("raid", lambda: job("raid"), {"part"})
+    scheduler.add("part", lambda: job("part"))
+    scheduler.run()
+
+    assert order == ["part", "raid", "fs"]
+
+#------------------------------------------------------------------------------
+
+def test_unknown_dependencies_are_satisfied():
+    scheduler = Scheduler()
+    scheduler.add("fs", lambda: "done", {"made-by-an-earlier-phase"})
+
+    assert scheduler.run() == {"fs": "done"}
+
+#------------------------------------------------------------------------------
+
+def test_shared_resources_never_overlap():
+    lock = Lock()
+    overlaps = []
+
+    def job():
+        if not lock.acquire(blocking=False):
+            overlaps.append(True)
+            return
+        sleep(0.02)
+        lock.release()
+
+    scheduler = Scheduler(4)
+    for name in ("a", "b", "c"):
+        scheduler.add(name, job, (), {"/dev/sda"})
+    scheduler.run()
+
+    assert not overlaps
+
+#------------------------------------------------------------------------------
+
+def test_cycle_raises():
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None, {"b"})
+    scheduler.add("b", lambda: None, {"a"})
+
+    with pytest.raises(Exception, match="Circular dependency"):
+        scheduler.run()
+
+#------------------------------------------------------------------------------
+
+def test_failure_stops_dependents():
+    ran = []
+
+    def fail():
+        raise ValueError("mkfs failed")
+
+    scheduler = Scheduler()
+    scheduler.add("a", fail)
+    scheduler.add("b", lambda: ran.append("b"), {"a"})
+
+    with pytest.raises(ValueError, match="mkfs failed"):
+        scheduler.run()
+
+    assert not ran
+
+# EOF
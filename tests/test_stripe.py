@@ -0,0 +1,49 @@
+import pytest
+
+from drive_utils import StripeGeometry, normalize_raid_level, get_data_disks
+from size_utils  import parse_size
+
+#------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("level, normalized", [
+    (5, "5"),
+    ("5", "5"),
+    ("raid5", "5"),
+    ("RAID6", "6"),
+    ("raid10", "10")
+])
+def test_normalize_raid_level(level, normalized):
+    assert normalize_raid_level(level) == normalized
+
+#------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("level, members, data_disks", [
+    (0, 4, 4),
+    ("raid5", 4, 3),
+    (6, 6, 4),
+    ("10", 4, 2),
+    (1, 2, None),
+    ("raid1", 2, None)
+])
+def test_get_data_disks(level, members, data_disks):
+    assert get_data_disks(level, members) == data_disks
+
+#------------------------------------------------------------------------------
+
+def test_stripe_width():
+    assert StripeGeometry(chunk_size=512, data_disks=3).stripe_width == 1536
+
+#------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("size, size_bytes", [
+    (4096, 4096),
+    ("512K", 512 * 1024),
+    ("64m", 64 * 1024 ** 2),
+    ("1.5G", int(1.5 * 1024 ** 3)),
+    ("2TB", 2 * 1024 ** 4),
+    ("", 0)
+])
+def test_parse_size(size, size_bytes):
+    assert parse_size(size) == size_bytes
+
+# EOF